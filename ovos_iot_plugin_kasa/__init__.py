@@ -1,166 +1,426 @@
-import time
-
-from lingua_franca.util.colors import Color
-from ovos_PHAL_plugin_commonIOT.opm.base import Sensor, IOTScannerPlugin, Plug
-from ovos_PHAL_plugin_commonIOT.opm.lights import Bulb, RGBBulb, RGBWBulb
-
-from ovos_iot_plugin_kasa.kasa import discover_devices, SmartPlug as _SP, SmartBulb as _SB, tplink_hsv_to_hsv, \
-    hsv_to_tplink_hsv
-
-
-class KasaDevice(Sensor):
-    def __init__(self, device_id, host, name="generic kasa device", raw_data=None):
-        device_id = device_id or f"Kasa:{host}"
-        raw_data = raw_data or {"name": name, "description": "uses tplink Kasa app"}
-        super().__init__(device_id, host, name, raw_data=raw_data)
-
-
-class KasaPlug(KasaDevice, Plug):
-
-    def __init__(self, device_id=None, host=None, name="smart plug", raw_data=None):
-        device_id = device_id or f"KasaPlug:{host}"
-        super().__init__(device_id, host, name, raw_data=raw_data)
-        self._plug = _SP(self.host)
+"""Kasa plugin for ovos-PHAL-plugin-commonIOT.
 
+Importing the package only loads the scanner plugin, pyHS100, lingua_franca
+and the device classes are imported on the first scan (or first access of
+a device class) so loading the plugin at startup stays cheap."""
+import time
 
-class KasaBulb(KasaDevice, Bulb):
-
-    def __init__(self, device_id=None, host=None, name="light bulb", raw_data=None):
-        device_id = device_id or f"KasaBulb:{host}"
-        super().__init__(device_id, host, name, raw_data=raw_data)
-        self._timer = None
-        self._bulb = _SB(self.host)
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTScannerPlugin
+
+from ovos_iot_plugin_kasa.metrics import get_metrics
+from ovos_iot_plugin_kasa.pool import get_pool
+from ovos_iot_plugin_kasa.registry import DeviceRegistry, DEFAULT_MAX_AGE
+from ovos_iot_plugin_kasa.scheduling import AdaptiveInterval, Backoff
+
+# seconds to wait for discovery broadcast replies
+DEFAULT_DISCOVERY_TIMEOUT = 3
+# max concurrent fallback sysinfo requests in flight during a scan
+DEFAULT_SCAN_WORKERS = 8
+# seconds a device gets to answer its sysinfo request during a scan
+DEFAULT_SYSINFO_TIMEOUT = 2
+# seconds a scanned device is served by get_device without probing it again
+DEFAULT_INDEX_TTL = 300
+# seconds between scans while devices come and go, doubles up to
+# DEFAULT_MAX_SCAN_FACTOR times that while the device set is stable
+DEFAULT_SCAN_INTERVAL = 15
+DEFAULT_MAX_SCAN_FACTOR = 4
+# first retry delay and cap in seconds for hosts failing their sysinfo request
+DEFAULT_BACKOFF_BASE = 5
+DEFAULT_BACKOFF_MAX = 300
+# seconds after a command before the device state is read back
+DEFAULT_REFRESH_DELAY = 0.5
+
+# re-exported from ovos_iot_plugin_kasa.devices on first access
+_LAZY_DEVICES = ("DEFAULT_CACHE_TTL", "KasaDevice", "KasaPlug", "KasaBulb",
+                 "KasaRGBBulb", "KasaRGBWBulb", "KasaStrip", "KasaStripOutlet")
+
+
+def __getattr__(name):
+    if name in _LAZY_DEVICES:
+        from ovos_iot_plugin_kasa import devices
+        return getattr(devices, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    @property
-    def as_dict(self):
-        data = super().as_dict
-        data.update({
-            "color": self.color.rgb255,
-            "is_color": self.is_color,
-            "is_dimmable": self.is_dimmable,
-            "is_variable_color_temp": self.is_variable_color_temp,
-            "brightness": self.brightness_255
-        })
-        return data
 
-    @property
-    def color(self):
-        if self.is_off:
-            return Color.from_rgb(0, 0, 0)
-        if self._bulb.is_color:
-            h, s, v = tplink_hsv_to_hsv(*self._bulb.hsv)
-            return Color.from_hsv(h, s, v)
-        return Color.from_rgb(255, 255, 255)
-
-    @property
-    def light_state(self):
-        return self.raw_data["light_state"]
+class KasaPlugin(IOTScannerPlugin):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool = get_pool()
+        pool.max_idle = self.config.get("max_idle_connections", pool.max_idle)
+        pool.idle_timeout = self.config.get("connection_idle_timeout", pool.idle_timeout)
+        self._devices = {}  # host -> most recently built device
+        minimum = self.config.get("min_scan_interval",
+                                  getattr(self, "_base_scan_interval", DEFAULT_SCAN_INTERVAL))
+        self._scan_interval = AdaptiveInterval(
+            minimum, self.config.get("max_scan_interval", minimum * DEFAULT_MAX_SCAN_FACTOR))
+        self._backoff = Backoff(self.config.get("backoff_base", DEFAULT_BACKOFF_BASE),
+                                self.config.get("backoff_max", DEFAULT_BACKOFF_MAX))
+        self._fleet = None  # hosts that answered the last discovery
+        self._fingerprints = {}  # host -> sysinfo fingerprint of the last emitted device
+        self._refreshing = set()  # hosts with a read back in flight
+        self._refresh_again = set()  # hosts commanded again during their read back
+        get_metrics().enabled = self.config.get("metrics", True)
+        if self.bus is not None:
+            self.bus.on("ovos.iot.kasa.metrics.get", self.handle_get_metrics)
+        self._warm = {}  # host -> device restored from the registry, not confirmed yet
+        self._announce = []  # (device, fingerprint) confirmed restored devices scan yields first
+        self.registry = None
+        if self.config.get("registry", True):
+            self.registry = DeviceRegistry(self.config.get("registry_path"),
+                                           self.config.get("registry_max_age", DEFAULT_MAX_AGE))
+            self._warm_start()
 
     @property
-    def is_color(self):
-        return self._bulb.is_color
+    def time_between_scans(self):
+        """ seconds until the next scan, grows while the device set is stable """
+        interval = getattr(self, "_scan_interval", None)
+        if interval is None:  # not set up yet
+            return getattr(self, "_base_scan_interval", DEFAULT_SCAN_INTERVAL)
+        return interval.value
+
+    @time_between_scans.setter
+    def time_between_scans(self, value):
+        self._base_scan_interval = value
+        interval = getattr(self, "_scan_interval", None)
+        if interval is not None:
+            interval.minimum = value
+            interval.maximum = max(interval.maximum, value)
+            interval.reset()
 
     @property
-    def is_dimmable(self):
-        return self._bulb.is_dimmable
+    def refresh_delay(self):
+        return self.config.get("refresh_delay", DEFAULT_REFRESH_DELAY)
 
     @property
-    def is_variable_color_temp(self):
-        return self._bulb.is_variable_color_temp
+    def min_write_interval(self):
+        from ovos_iot_plugin_kasa.devices import DEFAULT_WRITE_INTERVAL
+        return self.config.get("min_write_interval", DEFAULT_WRITE_INTERVAL)
 
     @property
-    def is_on(self):
-        return self._bulb.is_on
+    def cache_ttl(self):
+        from ovos_iot_plugin_kasa.devices import DEFAULT_CACHE_TTL
+        return self.config.get("cache_ttl", DEFAULT_CACHE_TTL)
 
     @property
-    def brightness(self):
-        return self._bulb.brightness
+    def index_ttl(self):
+        return self.config.get("index_ttl", DEFAULT_INDEX_TTL)
 
     @property
-    def color_temperatures(self):
-        return self._bulb.color_temp
+    def discovery_timeout(self):
+        return self.config.get("discovery_timeout", DEFAULT_DISCOVERY_TIMEOUT)
 
     @property
-    def current_consumption(self):
-        return self._bulb.get_emeter_realtime()
+    def discovery_target(self):
+        """ where discovery requests are sent, a subnet broadcast address or a single host """
+        return self.config.get("discovery_target", "255.255.255.255")
 
     @property
-    def daily_consumption(self, year=None, month=None):
-        return self._bulb.get_emeter_daily(year=year, month=month)
+    def scan_workers(self):
+        return self.config.get("scan_workers", DEFAULT_SCAN_WORKERS)
 
     @property
-    def monthly_consumption(self, year=None):
-        return self._bulb.get_emeter_monthly(year=year)
-
-    # status change
-    def turn_on(self):
-        self._bulb.turn_on()
-
-    def turn_off(self):
-        self._bulb.turn_off()
-
-    def change_brightness(self, value, percent=True):
-        if not percent:
-            raise NotImplementedError
-        if self._bulb.is_dimmable:
-            self._bulb.brightness = value
-
-    def change_color_temperatures(self, value, percent=True):
-        if not percent:
-            raise NotImplementedError
-        if self._bulb.is_variable_color_temp:
-            self._bulb.color_temp = value
-
-    def change_color(self, name):
-        if isinstance(name, Color):
-            if name.rgb == (0, 0, 0):
-                self.turn_off()
-            else:
-                if self.is_off:
-                    self.turn_on()
-                if self._bulb.is_color:
-                    self._bulb.hsv = hsv_to_tplink_hsv(*name.hsv)
+    def sysinfo_timeout(self):
+        return self.config.get("sysinfo_timeout", DEFAULT_SYSINFO_TIMEOUT)
+
+    def _build_device(self, host, raw):
+        from ovos_iot_plugin_kasa.aliases import get_alias_index
+        from ovos_iot_plugin_kasa.devices import KasaBulb, KasaPlug, KasaRGBWBulb, KasaStrip
+        from ovos_iot_plugin_kasa.handles import get_handles
+        from ovos_iot_plugin_kasa.kasa import device_type
+        kind = device_type(raw)
+        if kind == "bulb":
+            device_class = KasaRGBWBulb if raw.get("is_color") else KasaBulb
+        elif kind == "plug":
+            device_class = KasaPlug
+        elif kind == "strip":
+            device_class = KasaStrip
         else:
-            color = Color.from_name(name)
-            self.change_color(color)
-
-
-class KasaRGBBulb(KasaBulb, RGBBulb):
-
-    def __init__(self, device_id=None, host=None, name="rgb light bulb", raw_data=None):
-        device_id = device_id or f"KasaRGBBulb:{host}"
-        super().__init__(device_id, host, name, raw_data=raw_data)
-
-
-class KasaRGBWBulb(KasaRGBBulb, RGBWBulb):
-
-    def __init__(self, device_id=None, host=None, name="rgbw light bulb", raw_data=None):
-        device_id = device_id or f"KasaRGBWBulb:{host}"
-        super().__init__(device_id, host, name, raw_data=raw_data)
-
+            return None
+        alias = raw.get("alias") or host
+        device_id = f"{raw.get('dev_name') or alias}:{host}"
+        device = self._devices.get(host)
+        if device.__class__ is device_class and device.device_id == device_id:
+            # same device as last time, update it instead of allocating a new one
+            device.update_sysinfo(raw)
+            device.name = alias
+        else:
+            kwargs = {"min_write_interval": self.min_write_interval} if kind == "bulb" else {}
+            device = device_class(device_id, host, alias, raw_data=raw,
+                                  cache_ttl=self.cache_ttl, **kwargs)
+            device.on_command = self.schedule_refresh
+            device.sysinfo_timeout = self.sysinfo_timeout
+            device.optimistic = self.config.get("optimistic_state", True)
+            self._devices[host] = device
+            # the kasa.py helpers can skip their capability request for this ip
+            get_handles().learn(host, device.model_info, device.emeter_id)
+        get_alias_index().update(host, alias, kind)
+        if self.registry is not None:
+            self.registry.record(host, raw, raw.get("last_seen"))
+        return device
+
+    def _warm_start(self):
+        """ devices known from a previous run, usable before the first scan
+
+        capabilities are answered from the registry, state reads go to the
+        device. A background sysinfo request confirms each one, only
+        confirmed devices are yielded ahead of the first discovery"""
+        self.registry.load()
+        for host in self.registry.hosts():
+            device = self._build_device(host, self.registry.sysinfo(host))
+            if device is not None:
+                # no state is stored, the first read must go to the device
+                # however recent the stored last_seen is
+                device.invalidate()
+                self._warm[host] = device
+        if not self._warm:
+            return
+        from ovos_iot_plugin_kasa.aio import get_engine, async_get_sysinfo
+        engine = get_engine()
+        semaphore = engine.semaphore(self.scan_workers)
+        self._revalidating = len(self._warm)
+        for host in list(self._warm):
+            future = engine.submit_limited(semaphore,
+                                           async_get_sysinfo(host, self.sysinfo_timeout))
+            future.add_done_callback(lambda f, h=host: self._revalidated(h, f))
+
+    def _revalidated(self, host, future):
+        from ovos_utils.log import LOG
+        self._revalidating -= 1
+        try:
+            raw = future.result()
+        except Exception as e:
+            # stays usable, the next scan or get_device will tell
+            self._backoff.failure(host)
+            LOG.debug(f"Kasa device {host} from the registry did not answer: {e!r}")
+        else:
+            self._backoff.success(host)
+            self._warm.pop(host, None)
+            device = self._build_device(host, raw)
+            if device is not None:
+                from ovos_iot_plugin_kasa.kasa import sysinfo_fingerprint
+                self._announce.append((device, sysinfo_fingerprint(raw)))
+        if not self._revalidating:
+            self.registry.save()
+
+    def _scanned_device(self, host, raw):
+        """ device built from a scanned sysinfo, None if nothing changed since
+        the last time it was emitted """
+        from ovos_iot_plugin_kasa.kasa import sysinfo_fingerprint
+        fingerprint = sysinfo_fingerprint(raw)
+        device = self._devices.get(host)
+        if device is not None and not self.config.get("emit_unchanged", False) and \
+                self._fingerprints.get(host) == fingerprint:
+            device.raw_data["last_seen"] = now = time.time()
+            if self.registry is not None:
+                # seen again, keeps it from expiring out of the registry
+                self.registry.record(host, raw, now)
+            return None
+        device = self._build_device(host, raw)
+        if device is not None:
+            # only what scan yields counts as emitted, a device first built
+            # by get_device or the registry still has to be announced
+            self._fingerprints[host] = fingerprint
+        return device
+
+    @staticmethod
+    def _with_outlets(device):
+        """ a device followed by its outlets if it is a power strip """
+        return [device, *getattr(device, "outlets", ())]
 
-class KasaPlugin(IOTScannerPlugin):
     def scan(self):
-        for d in discover_devices():
+        from concurrent.futures import as_completed
+        from ovos_utils.log import LOG
+        from ovos_iot_plugin_kasa.aio import get_engine, async_get_sysinfo
+        from ovos_iot_plugin_kasa.kasa import discover_sysinfo, is_complete_sysinfo
+        engine = get_engine()
+        start = time.monotonic()
+        announce, self._announce = self._announce, []
+        for device, fingerprint in announce:
+            if self._fingerprints.get(device.host) == fingerprint:
+                continue  # a scan already yielded it
+            self._fingerprints[device.host] = fingerprint
+            yield from self._with_outlets(device)
+        found = {}
+        unchanged = []
+        failures = 0
+        skipped = 0
+        fleet = set()
+        semaphore = None
+        futures = {}
+        for host, raw in discover_sysinfo(timeout=self.discovery_timeout,
+                                           target=self.discovery_target):
+            fleet.add(host)
+            if is_complete_sysinfo(raw):
+                self._backoff.success(host)
+                device = self._scanned_device(host, raw)
+                if device is not None:
+                    for emitted in self._with_outlets(device):
+                        kind = emitted.__class__.__name__
+                        found[kind] = found.get(kind, 0) + 1
+                        yield emitted
+                elif host in self._devices:
+                    unchanged += [d.device_id for d in self._with_outlets(self._devices[host])]
+                continue
+            # missing or truncated discovery payload, ask the device directly
+            # runs concurrently in the engine loop, a slow or dead device
+            # only holds up itself
+            if not self._backoff.ready(host):
+                skipped += 1
+                continue
+            if semaphore is None:
+                semaphore = engine.semaphore(self.scan_workers)
+            fut = engine.submit_limited(semaphore, async_get_sysinfo(host, self.sysinfo_timeout))
+            futures[fut] = host
+        for fut in as_completed(futures):
+            host = futures[fut]
             try:
-                raw = dict(d.sys_info)
-            except:  # sometimes times out, next scan will pick it up
+                raw = fut.result()
+            except Exception as e:
+                failures += 1
+                delay = self._backoff.failure(host)
+                LOG.debug(f"Kasa device {host} sysinfo failed: {e!r}, retry in {delay:.0f}s")
                 continue
-            device_id = f"{raw.get('dev_name') or d.alias}:{d.host}"
-            raw["last_seen"] = time.time()
-            if isinstance(d, _SB):
-                if d.is_color:
-                    yield KasaRGBWBulb(device_id, d.host, d.alias, raw_data=raw)
-                else:
-                    yield KasaBulb(device_id, d.host, d.alias, raw_data=raw)
-            elif isinstance(d, _SP):
-                yield KasaPlug(device_id, d.host, d.alias, raw_data=raw)
+            self._backoff.success(host)
+            device = self._scanned_device(host, raw)
+            if device is not None:
+                for emitted in self._with_outlets(device):
+                    kind = emitted.__class__.__name__
+                    found[kind] = found.get(kind, 0) + 1
+                    yield emitted
+            elif host in self._devices:
+                unchanged += [d.device_id for d in self._with_outlets(self._devices[host])]
+        self._scan_interval.update(fleet != self._fleet)
+        self._fleet = fleet
+        for host in fleet:
+            self._warm.pop(host, None)
+        if self.registry is not None:
+            self.registry.save()
+        duration = time.monotonic() - start
+        get_metrics().record_scan(duration, found, fallbacks=len(futures),
+                                  failures=failures, skipped=skipped, unchanged=len(unchanged))
+        self.publish_heartbeat(unchanged)
+        self.publish_scan_summary({"duration": duration, "devices": found,
+                                   "fallbacks": len(futures), "failures": failures,
+                                   "skipped": skipped, "unchanged": len(unchanged)})
+
+    def publish_heartbeat(self, device_ids):
+        """ one message listing the devices a scan saw unchanged """
+        if self.bus is None or not device_ids:
+            return
+        from ovos_utils.messagebus import Message
+        self.bus.emit(Message("ovos.iot.kasa.heartbeat",
+                              {"device_ids": device_ids, "timestamp": time.time()}))
+
+    def schedule_refresh(self, device):
+        """ read back the state of a just commanded device in the background """
+        if device.host in self._refreshing:
+            self._refresh_again.add(device.host)
+            return
+        from ovos_iot_plugin_kasa.aio import get_engine
+        self._refreshing.add(device.host)
+        future = get_engine().submit(self._refresh(device))
+        future.add_done_callback(lambda _: self._refresh_done(device))
+
+    def _refresh_done(self, device):
+        self._refreshing.discard(device.host)
+        if device.host in self._refresh_again:
+            self._refresh_again.discard(device.host)
+            self.schedule_refresh(device)
+
+    async def _refresh(self, device):
+        import asyncio
+        from ovos_utils.log import LOG
+        from ovos_iot_plugin_kasa.aio import async_get_sysinfo
+        await asyncio.sleep(self.refresh_delay)
+        requested_at = time.time()
+        try:
+            raw = await async_get_sysinfo(device.host, self.sysinfo_timeout)
+        except Exception as e:
+            delay = self._backoff.failure(device.host)
+            LOG.debug(f"Kasa device {device.host} read back failed: {e!r}, retry in {delay:.0f}s")
+            return
+        self._backoff.success(device.host)
+        diverged = device.confirm(raw, requested_at)
+        if diverged:
+            self.report_divergence(device, diverged)
+
+    def report_divergence(self, device, diverged):
+        """ the device does not report what was written to it """
+        from ovos_utils.log import LOG
+        LOG.info(f"Kasa device {device.device_id} state diverged (written, reported): {diverged}")
+        if self.bus is None:
+            return
+        from ovos_utils.messagebus import Message
+        self.bus.emit(Message("ovos.iot.kasa.state.diverged",
+                              {"device_id": device.device_id,
+                               "host": device.host,
+                               "fields": {k: {"written": w, "reported": r}
+                                          for k, (w, r) in diverged.items()}}))
+
+    @property
+    def metrics(self):
+        return get_metrics()
+
+    def publish_scan_summary(self, summary):
+        """ a few counters per scan, the full metrics snapshot is only sent
+        in reply to ovos.iot.kasa.metrics.get, its size grows with the fleet """
+        if self.bus is None:
+            return
+        from ovos_utils.messagebus import Message
+        self.bus.emit(Message("ovos.iot.kasa.scan", summary))
+
+    def publish_metrics(self, message=None):
+        """ emit a metrics snapshot on the bus, as a reply if message is given """
+        if self.bus is None:
+            return
+        from ovos_utils.messagebus import Message
+        data = get_metrics().snapshot()
+        if message is not None:
+            self.bus.emit(message.reply("ovos.iot.kasa.metrics", data))
+        else:
+            self.bus.emit(Message("ovos.iot.kasa.metrics", data))
+
+    def handle_get_metrics(self, message):
+        self.publish_metrics(message)
+
+    def group(self, devices):
+        """ KasaGroup to change many devices at once """
+        from ovos_iot_plugin_kasa.groups import KasaGroup, DEFAULT_CONCURRENCY, DEFAULT_DEADLINE
+        return KasaGroup(devices,
+                         concurrency=self.config.get("group_concurrency", DEFAULT_CONCURRENCY),
+                         deadline=self.config.get("group_deadline", DEFAULT_DEADLINE))
+
+    def sampler(self, devices):
+        """ EmeterSampler polling realtime consumption of the given devices
+
+        power strips are sampled per outlet, pass the outlets instead"""
+        from ovos_iot_plugin_kasa.devices import KasaBulb, KasaStrip
+        from ovos_iot_plugin_kasa.sampler import EmeterSampler
+        sampler = EmeterSampler(interval=self.config.get("sample_interval", 1.0),
+                                buffer_size=self.config.get("sample_buffer_size", 3600))
+        for device in devices:
+            if isinstance(device, KasaStrip):
+                continue  # only meters one outlet per request
+            sampler.add_device(device.device_id, device.host, bulb=isinstance(device, KasaBulb),
+                               child_id=getattr(device, "child_id", None))
+        return sampler
 
     def get_device(self, ip):
-        for device in self.scan():
-            if device.host == ip:
-                return device
-        return None
+        """ recently seen device for ip, else built from a single unicast probe """
+        device = self._devices.get(ip)
+        if device is not None and (ip in self._warm or
+                                   time.time() - device.raw_data.get("last_seen", 0) < self.index_ttl):
+            return device
+        from ovos_utils.log import LOG
+        from ovos_iot_plugin_kasa.kasa import get_sysinfo
+        try:
+            raw = get_sysinfo(ip, timeout=self.sysinfo_timeout)
+        except Exception as e:
+            self._backoff.failure(ip)
+            LOG.debug(f"Kasa device {ip} sysinfo failed: {e}")
+            return None
+        self._backoff.success(ip)
+        return self._build_device(ip, raw)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,268 @@
+import asyncio
+import socket
+import threading
+from time import monotonic
+
+from ovos_iot_plugin_kasa.commands import KasaCommand, LIGHT_SERVICE, SYSINFO_QUERY, BULB_EMETER, \
+    PLUG_EMETER
+from ovos_iot_plugin_kasa.metrics import command_label, get_metrics
+from ovos_iot_plugin_kasa.pool import PORT
+from ovos_iot_plugin_kasa.protocol import DISCOVERY_RCVBUF, encode_request, encode_datagram, \
+    decode_response, frame_length
+
+
+# protocol
+
+
+async def async_query(host, request, port=PORT, timeout=5):
+    """Send a request to a device over TCP and return the decoded reply."""
+
+    frame = encode_request(request)
+
+    async def _exchange():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(frame)
+            await writer.drain()
+            length = frame_length(await reader.readexactly(4))
+            payload = await reader.readexactly(length)
+        finally:
+            writer.close()
+        return payload
+
+    metrics = get_metrics()
+    start = monotonic()
+    try:
+        payload = await asyncio.wait_for(_exchange(), timeout)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+        metrics.record_failure(host, command_label(request), e, sent=len(frame),
+                               timeout=isinstance(e, asyncio.TimeoutError))
+        raise
+    metrics.record_request(host, command_label(request), monotonic() - start,
+                           sent=len(frame), received=4 + len(payload))
+    return decode_response(payload)
+
+
+async def async_query_helper(host, target, cmd, arg=None, port=PORT, timeout=5, child_id=None):
+    command = KasaCommand().add(target, cmd, arg)
+    if child_id is not None:
+        # one outlet of a power strip
+        command.children([child_id])
+    response = await async_query(host, command.request, port=port, timeout=timeout)
+    return KasaCommand.parse(response)[(target, cmd)]
+
+
+async def async_query_many(hosts, request, concurrency=32, port=PORT, timeout=5):
+    """Send the same request to many devices at once.
+
+    returns {host: reply}, a host that failed maps to its exception"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(host):
+        async with semaphore:
+            return await async_query(host, request, port=port, timeout=timeout)
+
+    results = await asyncio.gather(*[_one(h) for h in hosts], return_exceptions=True)
+    return dict(zip(hosts, results))
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait((addr[0], data))
+
+
+async def async_discover(timeout=3, port=PORT, target="255.255.255.255"):
+    """Broadcast a sysinfo request and yield (ip, sysinfo) as devices answer.
+
+    The discovery reply already carries the full sysinfo, so no unicast
+    connection is needed. sysinfo is None if the reply can not be decoded"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _DiscoveryProtocol(queue), local_addr=("0.0.0.0", 0), allow_broadcast=True)
+    # a large fleet answers in a burst the default buffer would drop
+    transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                                  DISCOVERY_RCVBUF)
+    metrics = get_metrics()
+    start = monotonic()
+    deadline = start + timeout
+    seen = set()
+    try:
+        transport.sendto(encode_datagram(SYSINFO_QUERY), (target, port))
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                ip, data = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if ip in seen:
+                continue
+            seen.add(ip)
+            try:
+                sysinfo = decode_response(data)["system"]["get_sysinfo"]
+            except (ValueError, KeyError, TypeError):
+                sysinfo = None
+            metrics.record_discovery_reply(monotonic() - start, len(data), sysinfo is not None)
+            yield ip, sysinfo
+    finally:
+        transport.close()
+        metrics.record_discovery(monotonic() - start)
+
+
+# device helpers
+
+
+async def async_get_sysinfo(host, timeout=5):
+    return await async_query_helper(host, "system", "get_sysinfo", timeout=timeout)
+
+
+async def async_plug_turn_on(host, timeout=5):
+    return await async_query_helper(host, "system", "set_relay_state", {"state": 1},
+                                    timeout=timeout)
+
+
+async def async_plug_turn_off(host, timeout=5):
+    return await async_query_helper(host, "system", "set_relay_state", {"state": 0},
+                                    timeout=timeout)
+
+
+async def async_plug_led(host, state=True, timeout=5):
+    # the device flag is "led off"
+    return await async_query_helper(host, "system", "set_led_off", {"off": int(not state)},
+                                    timeout=timeout)
+
+
+async def async_get_plug_state(host, timeout=5):
+    sysinfo = await async_get_sysinfo(host, timeout=timeout)
+    return "ON" if sysinfo["relay_state"] == 1 else "OFF"
+
+
+async def async_set_light_state(host, state, timeout=5):
+    return await async_query_helper(host, LIGHT_SERVICE, "transition_light_state", state,
+                                    timeout=timeout)
+
+
+async def async_get_light_state(host, timeout=5):
+    return await async_query_helper(host, LIGHT_SERVICE, "get_light_state", timeout=timeout)
+
+
+async def async_bulb_turn_on(host, timeout=5):
+    return await async_set_light_state(host, {"on_off": 1}, timeout=timeout)
+
+
+async def async_bulb_turn_off(host, timeout=5):
+    return await async_set_light_state(host, {"on_off": 0}, timeout=timeout)
+
+
+async def async_set_bulb_brightness(host, percentage=100, timeout=5):
+    percentage = max(0, min(100, int(percentage)))
+    return await async_set_light_state(host, {"brightness": percentage}, timeout=timeout)
+
+
+async def async_set_bulb_color_temperature(host, value=3000, timeout=5):
+    return await async_set_light_state(host, {"color_temp": int(value)}, timeout=timeout)
+
+
+async def async_set_bulb_hsv(host, hue, saturation, value, timeout=5):
+    """ set a color, hue/saturation/value in tplink ranges (360/100/100) """
+    return await async_set_light_state(host, {"hue": hue, "saturation": saturation,
+                                              "brightness": value, "color_temp": 0},
+                                       timeout=timeout)
+
+
+async def async_get_emeter_realtime(host, bulb=False, timeout=5, child_id=None):
+    target = BULB_EMETER if bulb else PLUG_EMETER
+    return await async_query_helper(host, target, "get_realtime", timeout=timeout,
+                                    child_id=child_id)
+
+
+async def async_get_emeter_daily(host, year, month, bulb=False, timeout=5):
+    target = BULB_EMETER if bulb else PLUG_EMETER
+    return await async_query_helper(host, target, "get_daystat",
+                                    {"year": year, "month": month}, timeout=timeout)
+
+
+async def async_get_emeter_monthly(host, year, bulb=False, timeout=5):
+    target = BULB_EMETER if bulb else PLUG_EMETER
+    return await async_query_helper(host, target, "get_monthstat", {"year": year},
+                                    timeout=timeout)
+
+
+# sync facade
+
+
+async def _limited(semaphore, coro):
+    async with semaphore:
+        return await coro
+
+
+async def _new_semaphore(value):
+    # the semaphore must be created inside the engine loop
+    return asyncio.Semaphore(value)
+
+
+class KasaEngine:
+    """Runs the asyncio client in a background event loop.
+
+    Lets sync code (KasaPlugin, the device classes, skills) schedule many
+    device requests at once and wait on plain concurrent.futures."""
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name="KasaEngine", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def submit(self, coro):
+        """ schedule a coroutine, returns a concurrent.futures.Future """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    def semaphore(self, value):
+        return self.run(_new_semaphore(value))
+
+    def submit_limited(self, semaphore, coro):
+        """ schedule a coroutine that waits on semaphore before running """
+        return self.submit(_limited(semaphore, coro))
+
+    def query(self, host, request, port=PORT, timeout=5):
+        return self.run(async_query(host, request, port=port, timeout=timeout))
+
+    def query_many(self, hosts, request, concurrency=32, port=PORT, timeout=5):
+        return self.run(async_query_many(hosts, request, concurrency=concurrency,
+                                         port=port, timeout=timeout))
+
+    def get_sysinfo(self, host, timeout=5):
+        return self.run(async_get_sysinfo(host, timeout=timeout))
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = self._thread = None
+
+
+_ENGINE = KasaEngine()
+
+
+def get_engine():
+    """ shared engine, its loop thread is only started on first use """
+    return _ENGINE
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import namedtuple
+from difflib import get_close_matches
+
+AliasEntry = namedtuple("AliasEntry", ["host", "alias", "kind", "last_seen"])
+
+
+def normalize_alias(alias):
+    return " ".join(alias.casefold().split())
+
+
+class AliasIndex:
+    """Case insensitive device name -> host index, fed by scans and discovery.
+
+    Several devices may share an alias, lookups return every match with the
+    most recently seen first. Renamed devices drop their old alias"""
+
+    def __init__(self, fuzzy_cutoff=0.8):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self._by_alias = {}  # normalized alias -> {host: AliasEntry}
+        self._by_host = {}  # host -> normalized alias
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_host)
+
+    def update(self, host, alias, kind=None):
+        key = normalize_alias(alias)
+        with self._lock:
+            old = self._by_host.get(host)
+            if old is not None and old != key:
+                self._by_alias[old].pop(host, None)
+                if not self._by_alias[old]:
+                    del self._by_alias[old]
+            self._by_host[host] = key
+            self._by_alias.setdefault(key, {})[host] = \
+                AliasEntry(host, alias, kind, time.time())
+
+    def remove(self, host):
+        with self._lock:
+            key = self._by_host.pop(host, None)
+            if key is not None:
+                self._by_alias[key].pop(host, None)
+                if not self._by_alias[key]:
+                    del self._by_alias[key]
+
+    def lookup(self, name, fuzzy=False):
+        """ AliasEntry list for name, most recently seen first """
+        key = normalize_alias(name)
+        with self._lock:
+            entries = list(self._by_alias.get(key, {}).values())
+            if not entries and fuzzy:
+                for match in get_close_matches(key, self._by_alias, n=1,
+                                               cutoff=self.fuzzy_cutoff):
+                    entries = list(self._by_alias[match].values())
+        return sorted(entries, key=lambda e: e.last_seen, reverse=True)
+
+    def resolve(self, name, fuzzy=False):
+        """ best matching AliasEntry or None """
+        entries = self.lookup(name, fuzzy=fuzzy)
+        return entries[0] if entries else None
+
+
+_INDEX = AliasIndex()
+
+
+def get_alias_index():
+    """ index shared by KasaPlugin scans and find_host_from_device_name """
+    return _INDEX
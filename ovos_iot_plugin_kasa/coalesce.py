@@ -0,0 +1,104 @@
+import threading
+from time import monotonic
+
+from ovos_utils.log import LOG
+
+
+class LatestWins:
+    """Coalesces rapid writes to one device so only the newest state is sent.
+
+    A write goes out right away (in the caller's thread) if the device is
+    idle and the last write is at least min_interval old. Otherwise it is
+    merged into the pending state, later values replacing earlier ones key
+    by key, and a timer sends whatever is pending once the device is free.
+    The last state submitted is always sent, writes merged away before
+    being sent are counted as dropped"""
+    __slots__ = ("send", "min_interval", "name", "_pending", "_timer", "_sending", "_last_send",
+                 "_lock", "submitted", "sent", "dropped", "failed")
+
+    def __init__(self, send, min_interval=0.1, name="kasa"):
+        self.send = send  # callable(state dict)
+        self.min_interval = min_interval
+        self.name = name
+        self._pending = None
+        self._timer = None
+        self._sending = False
+        self._last_send = 0
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {"submitted": self.submitted,
+                    "sent": self.sent,
+                    "dropped": self.dropped,
+                    "failed": self.failed,
+                    "pending": self._pending is not None}
+
+    def _schedule(self, delay):
+        # caller holds the lock
+        self._timer = threading.Timer(max(0.0, delay), self._flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def submit(self, state):
+        """ queue a target state, sends it now if the device is free """
+        with self._lock:
+            self.submitted += 1
+            if self._pending is None:
+                self._pending = dict(state)
+            else:
+                self.dropped += 1
+                self._pending.update(state)
+            if self._sending or self._timer is not None:
+                return  # goes out with the next flush
+            delay = self._last_send + self.min_interval - monotonic()
+            if delay > 0:
+                self._schedule(delay)
+                return
+            state, self._pending = self._pending, None
+            self._sending = True
+        # errors reach the caller when its own write is the one sent
+        self._send(state, reraise=True)
+
+    def _send(self, state, reraise=False):
+        try:
+            self.send(state)
+        except Exception as e:
+            self.failed += 1
+            if reraise:
+                raise
+            LOG.error(f"{self.name} coalesced write {state} failed: {e}")
+        else:
+            self.sent += 1
+        finally:
+            with self._lock:
+                self._sending = False
+                self._last_send = monotonic()
+                if self._pending is not None and self._timer is None:
+                    self._schedule(self.min_interval)
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if self._pending is None or self._sending:
+                return
+            state, self._pending = self._pending, None
+            self._sending = True
+        self._send(state)
+
+    def flush(self):
+        """ send the pending state now instead of waiting for the timer """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pending is None or self._sending:
+                return
+            state, self._pending = self._pending, None
+            self._sending = True
+        self._send(state, reraise=True)
@@ -0,0 +1,140 @@
+"""Color conversions in tplink ranges (hue 0-360, saturation / value 0-100).
+
+The name -> hsv table and the nearest name index are built once on first
+use, batch conversions take numpy arrays and need numpy installed."""
+import colorsys
+import threading
+
+_lock = threading.Lock()
+_NAME_TABLE = None
+_NAME_INDEX = None
+
+
+def _css3_names():
+    import webcolors
+    try:
+        return {name: webcolors.name_to_hex(name) for name in webcolors.names("css3")}
+    except AttributeError:  # webcolors < 24.6
+        return dict(webcolors.CSS3_NAMES_TO_HEX)
+
+
+def rgb_to_tplink_hsv(r, g, b):
+    h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+    return int(h * 360), int(s * 100), int(v * 100)
+
+
+def tplink_hsv_to_rgb(h, s, v):
+    r, g, b = colorsys.hsv_to_rgb(h / 360, s / 100, v / 100)
+    return int(r * 255), int(g * 255), int(b * 255)
+
+
+class _KDTree:
+    """ nearest neighbour lookup over the palette in rgb space """
+
+    def __init__(self, points):
+        # points: [((r, g, b), name)]
+        self.root = self._build(points, 0)
+
+    def _build(self, points, axis):
+        if not points:
+            return None
+        points = sorted(points, key=lambda p: p[0][axis])
+        mid = len(points) // 2
+        return (points[mid], axis,
+                self._build(points[:mid], (axis + 1) % 3),
+                self._build(points[mid + 1:], (axis + 1) % 3))
+
+    def nearest(self, rgb):
+        best = [None, float("inf")]
+
+        def visit(node):
+            if node is None:
+                return
+            (point, name), axis, left, right = node
+            dist = sum((a - b) ** 2 for a, b in zip(point, rgb))
+            if dist < best[1]:
+                best[0], best[1] = name, dist
+            diff = rgb[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            if diff * diff < best[1]:
+                visit(far)
+
+        visit(self.root)
+        return best[0]
+
+
+def _build():
+    global _NAME_TABLE, _NAME_INDEX
+    with _lock:
+        if _NAME_TABLE is None:
+            table = {}
+            points = []
+            for name, hex_color in _css3_names().items():
+                rgb = tuple(int(hex_color.lstrip("#")[i:i + 2], 16) for i in (0, 2, 4))
+                table[name] = rgb_to_tplink_hsv(*rgb)
+                points.append((rgb, name))
+            _NAME_INDEX = _KDTree(points)
+            _NAME_TABLE = table
+
+
+def name_table():
+    """ {css3 color name: tplink (h, s, v)} """
+    if _NAME_TABLE is None:
+        _build()
+    return _NAME_TABLE
+
+
+def name_to_tplink_hsv(name):
+    """ tplink (h, s, v) for a color name, None if unknown """
+    return name_table().get(name.lower().replace(" ", ""))
+
+
+def tplink_hsv_to_name(h, s, v):
+    """ closest css3 color name for a tplink hsv """
+    if _NAME_INDEX is None:
+        _build()
+    return _NAME_INDEX.nearest(tplink_hsv_to_rgb(h, s, v))
+
+
+# batch versions, numpy arrays of shape (N, 3)
+
+
+def hsv_to_tplink_hsv_batch(hsv):
+    """ colorsys ranges (h, s 0-1, v 0-255) -> int tplink ranges """
+    import numpy as np
+    # same operation order as hsv_to_tplink_hsv so results match exactly
+    out = np.asarray(hsv, dtype=np.float64) * np.array([360.0, 100.0, 100.0])
+    out /= np.array([1.0, 1.0, 255.0])
+    return out.astype(np.int32)
+
+
+def tplink_hsv_to_hsv_batch(hsv):
+    """ tplink ranges -> colorsys ranges (h, s 0-1, v 0-255) """
+    import numpy as np
+    out = np.asarray(hsv, dtype=np.float64) / np.array([360.0, 100.0, 100.0])
+    out[:, 2] = np.floor(out[:, 2] * 255)
+    return out
+
+
+def rgb_to_tplink_hsv_batch(rgb):
+    """ rgb 0-255 -> int tplink hsv """
+    import numpy as np
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    delta = maxc - minc
+    s = np.divide(delta, maxc, out=np.zeros_like(maxc), where=maxc > 0)
+    safe = np.where(delta > 0, delta, 1)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    rc = (maxc - r) / safe
+    gc = (maxc - g) / safe
+    bc = (maxc - b) / safe
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(delta > 0, (h / 6.0) % 1.0, 0.0)
+    return np.stack([h * 360, s * 100, maxc * 100], axis=1).astype(np.int32)
+
+
+def tplink_hsv_to_name_batch(hsv):
+    """ closest css3 color name for every row """
+    return [tplink_hsv_to_name(h, s, v) for h, s, v in hsv]
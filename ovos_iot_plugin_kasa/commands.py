@@ -0,0 +1,109 @@
+from pyHS100 import SmartDeviceException
+
+from ovos_iot_plugin_kasa.pool import get_pool
+
+SYSINFO_QUERY = {"system": {"get_sysinfo": None}}
+LIGHT_SERVICE = "smartlife.iot.smartbulb.lightingservice"
+BULB_EMETER = "smartlife.iot.common.emeter"
+PLUG_EMETER = "emeter"
+# kelvin range by model prefix
+TEMP_RANGES = {
+    "LB130": (2500, 9000),
+    "LB230": (2500, 9000),
+    "KB130": (2500, 9000),
+    "KL130": (2500, 9000),
+    "LB120": (2700, 6500),
+    "KL120": (2700, 6500)
+}
+DEFAULT_TEMP_RANGE = (2700, 6500)
+
+
+def temp_range(model):
+    """ (min, max) kelvin supported by a bulb model """
+    for prefix, kelvin in TEMP_RANGES.items():
+        if (model or "").startswith(prefix):
+            return kelvin
+    return DEFAULT_TEMP_RANGE
+
+
+def percent_to_kelvin(model, percent):
+    low, high = temp_range(model)
+    percent = max(0, min(100, percent))
+    return int(low + (high - low) * percent / 100)
+
+
+class KasaCommand:
+    """Builds a single request carrying commands for several modules.
+
+    The device executes every module of a request and answers them all in
+    one reply, light changes are merged into one transition_light_state
+    so on_off + color + brightness + color_temp is a single round trip
+
+        KasaCommand().light_state(on_off=1, hue=120).sysinfo().send(host)
+    """
+
+    def __init__(self):
+        self.request = {}
+
+    def add(self, target, cmd, arg=None):
+        self.request.setdefault(target, {})[cmd] = arg
+        return self
+
+    def light_state(self, **state):
+        """ merge keys into this request's transition_light_state """
+        module = self.request.setdefault(LIGHT_SERVICE, {})
+        current = module.get("transition_light_state") or {}
+        current.update(state)
+        module["transition_light_state"] = current
+        return self
+
+    def turn_on(self):
+        return self.light_state(on_off=1)
+
+    def turn_off(self):
+        return self.light_state(on_off=0)
+
+    def hsv(self, hue, saturation, value):
+        """ tplink ranges, hue 0-360, saturation and value 0-100 """
+        return self.light_state(hue=hue, saturation=saturation, brightness=value, color_temp=0)
+
+    def brightness(self, value):
+        return self.light_state(brightness=value)
+
+    def color_temp(self, kelvin):
+        return self.light_state(color_temp=kelvin)
+
+    def relay(self, on):
+        return self.add("system", "set_relay_state", {"state": int(bool(on))})
+
+    def led(self, on):
+        return self.add("system", "set_led_off", {"off": int(not on)})
+
+    def sysinfo(self):
+        return self.add("system", "get_sysinfo")
+
+    def children(self, child_ids):
+        """ address the request to these outlets of a power strip """
+        self.request["context"] = {"child_ids": list(child_ids)}
+        return self
+
+    def __bool__(self):
+        return bool(self.request)
+
+    @staticmethod
+    def parse(reply):
+        """ {(target, cmd): result} for a reply, raise if any command failed """
+        results = {}
+        for target, cmds in reply.items():
+            if not isinstance(cmds, dict):
+                continue
+            for cmd, result in cmds.items():
+                result = dict(result)
+                if result.pop("err_code", 0) != 0:
+                    raise SmartDeviceException(f"{target}.{cmd} failed: {result}")
+                results[(target, cmd)] = result
+        return results
+
+    def send(self, host, timeout=None):
+        """ send everything in one request, returns parse() of the reply """
+        return self.parse(get_pool().query(host, self.request, timeout=timeout))
@@ -0,0 +1,606 @@
+"""Kasa device classes, imported lazily by the plugin on first scan.
+
+lingua_franca is only imported by the color operations."""
+import time
+
+from ovos_PHAL_plugin_commonIOT.opm.base import Sensor, Plug
+from ovos_PHAL_plugin_commonIOT.opm.lights import Bulb, RGBBulb, RGBWBulb
+
+from ovos_iot_plugin_kasa.coalesce import LatestWins
+from ovos_iot_plugin_kasa.colors import name_to_tplink_hsv
+from ovos_iot_plugin_kasa.commands import KasaCommand, LIGHT_SERVICE, percent_to_kelvin
+from ovos_iot_plugin_kasa.emeter import get_emeter_store
+from ovos_iot_plugin_kasa.handles import get_handles
+from ovos_iot_plugin_kasa.models import model_info, device_state
+from ovos_iot_plugin_kasa.kasa import get_sysinfo, tplink_hsv_to_hsv, hsv_to_tplink_hsv
+from ovos_iot_plugin_kasa.operations import DEFAULT_OFF_TIME, async_reboot, run_operation
+from ovos_iot_plugin_kasa.pool import get_pool
+
+# seconds a get_sysinfo snapshot is considered fresh
+DEFAULT_CACHE_TTL = 2
+# min seconds between two light state writes to the same bulb, faster
+# changes (e.g. dragging a slider) are coalesced into the newest one
+DEFAULT_WRITE_INTERVAL = 0.1
+
+
+class KasaDevice(Sensor):
+    """Base for kasa devices.
+
+    raw_data only keeps the per device part of sysinfo (alias, ids, state),
+    what the model can do is in model_info, shared by all devices of that
+    model. Plugin scans update devices in place instead of replacing them"""
+    # the commonIOT base classes are not slotted, slots still keep our own
+    # per device attributes out of the instance dict
+    __slots__ = ("_snapshot_time", "cache_ttl", "cache_hits", "cache_misses", "on_command",
+                 "model_info", "_handle", "optimistic", "_expected", "_expected_at",
+                 "sysinfo_timeout")
+
+    def __init__(self, device_id, host, name="generic kasa device", raw_data=None,
+                 cache_ttl=DEFAULT_CACHE_TTL):
+        device_id = device_id or f"Kasa:{host}"
+        super().__init__(device_id, host, name,
+                         raw_data={"name": name, "description": "uses tplink Kasa app"})
+        self.model_info = None
+        self._handle = None
+        self._snapshot_time = 0
+        if raw_data:
+            # raw_data coming from a scan is a sysinfo snapshot taken at "last_seen"
+            self.update_sysinfo(raw_data, raw_data.get("last_seen", 0))
+        self.cache_ttl = cache_ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # called with the device after every successful command
+        self.on_command = None
+        # serve reads from the state just written instead of asking the device
+        self.optimistic = False
+        self._expected = None  # fields of the last optimistic write
+        self._expected_at = 0
+        # seconds a sysinfo read may take, None for the connection pool default
+        self.sysinfo_timeout = None
+
+    def _get_sysinfo(self):
+        return get_sysinfo(self.host, timeout=self.sysinfo_timeout)
+
+    @property
+    def model(self):
+        return self.model_info.model if self.model_info else None
+
+    @property
+    def sys_info(self):
+        """ get_sysinfo snapshot, only queries the device once per cache_ttl """
+        if time.time() - self._snapshot_time < self.cache_ttl:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            self.refresh()
+        return self.raw_data
+
+    @property
+    def cache_stats(self):
+        return {"hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "ttl": self.cache_ttl}
+
+    def refresh(self):
+        return self.update_sysinfo(self._get_sysinfo())
+
+    def update_sysinfo(self, sysinfo, timestamp=None):
+        """ replace the snapshot with a sysinfo reply fetched elsewhere """
+        self.model_info = model_info(sysinfo)
+        raw = device_state(sysinfo)
+        raw["last_seen"] = self._snapshot_time = timestamp or time.time()
+        self.raw_data = raw
+        return raw
+
+    def invalidate(self):
+        self._snapshot_time = 0
+
+    @property
+    def has_emeter(self):
+        # capabilities never change, any snapshot will do
+        if self.model_info is None:
+            self.refresh()
+        return self.model_info.has_emeter
+
+    @property
+    def as_dict(self):
+        self.sys_info  # a stale or restored snapshot is refreshed first
+        data = super().as_dict
+        if self.model_info is not None:
+            data["model"] = self.model_info.as_dict
+        return data
+
+    @property
+    def emeter_id(self):
+        """ key for the emeter store, stable across ip changes when known """
+        return self.raw_data.get("deviceId") or self.host
+
+    def command_for_state(self, on=None, **state):
+        """ batched KasaCommand taking the device to the requested state """
+        raise NotImplementedError
+
+    def _apply_results(self, command, results):
+        self.invalidate()
+
+    def _flat_state(self, sysinfo):
+        """ sysinfo as {field: value} comparable with the written fields """
+        return sysinfo
+
+    def _written(self, fields):
+        """ local state now holds a successful write, in optimistic mode it is
+        served until the snapshot expires or a read back replaces it """
+        if self.optimistic:
+            self._expected = fields
+            self._expected_at = self._snapshot_time = time.time()
+
+    def confirm(self, sysinfo, requested_at):
+        """Apply a read back of the device state.
+
+        Returns {field: (written, reported)} for written fields the device
+        reports differently, it rejected the change or someone else changed
+        it since. None if a newer write happened while the read back was in
+        flight, the reply is outdated and ignored"""
+        if self._expected_at > requested_at:
+            return None
+        expected, self._expected = self._expected, None
+        reported = self._flat_state(sysinfo)
+        self.update_sysinfo(sysinfo)
+        if not expected:
+            return {}
+        return {k: (v, reported[k]) for k, v in expected.items()
+                if k in reported and reported[k] != v}
+
+    def _commanded(self):
+        if self.on_command is not None:
+            self.on_command(self)
+
+    def _send(self, command, timeout=None):
+        """ send a batched command in a single round trip """
+        if not command:
+            return None
+        try:
+            results = command.send(self.host, timeout=timeout)
+        except Exception:
+            # rejected or lost, the local state can not be trusted
+            self._expected = None
+            self.invalidate()
+            raise
+        self._apply_results(command, results)
+        self._commanded()
+        return results
+
+
+class KasaPlug(KasaDevice, Plug):
+    __slots__ = ()
+
+    def __init__(self, device_id=None, host=None, name="smart plug", raw_data=None,
+                 cache_ttl=DEFAULT_CACHE_TTL):
+        device_id = device_id or f"KasaPlug:{host}"
+        super().__init__(device_id, host, name, raw_data=raw_data, cache_ttl=cache_ttl)
+
+    @property
+    def _plug(self):
+        """ pyHS100 handle, only created if something needs it """
+        if self._handle is None:
+            self._handle = get_handles().plug(self.host)
+        return self._handle
+
+    @property
+    def is_on(self):
+        return self.sys_info["relay_state"] == 1
+
+    @property
+    def current_consumption(self):
+        return self._plug.get_emeter_realtime()
+
+    def daily_consumption(self, year=None, month=None):
+        """ {day: kWh}, finished months are served from the local emeter store,
+        None for plugs without energy meter """
+        if self.has_emeter:
+            return get_emeter_store().get_daily(self.emeter_id, self.host, year, month, kwh=True)
+
+    def monthly_consumption(self, year=None):
+        """ {month: kWh}, finished months are served from the local emeter store,
+        None for plugs without energy meter """
+        if self.has_emeter:
+            return get_emeter_store().get_monthly(self.emeter_id, self.host, year, kwh=True)
+
+    def command_for_state(self, on=None, **state):
+        command = KasaCommand()
+        if on is not None:
+            command.relay(on)
+        return command
+
+    def _apply_results(self, command, results):
+        relay = command.request.get("system", {}).get("set_relay_state")
+        if relay is not None:
+            self.raw_data["relay_state"] = relay["state"]
+            self._written({"relay_state": relay["state"]})
+        else:
+            self.invalidate()
+
+    # status change
+    def turn_on(self):
+        self._send(self.command_for_state(on=True))
+
+    def turn_off(self):
+        self._send(self.command_for_state(on=False))
+
+    def reboot(self, off_time=DEFAULT_OFF_TIME, timeout=None, countdown=False):
+        """ power cycle without blocking, returns a Future with the final sysinfo """
+        self._expected = None
+        self.invalidate()
+        future = run_operation(async_reboot(self.host, off_time, timeout, countdown))
+        future.add_done_callback(self._rebooted)
+        return future
+
+    def _rebooted(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.update_sysinfo(future.result())
+        else:
+            self.invalidate()
+
+
+def _summed(readings):
+    total = {}
+    for reading in readings:
+        for key, value in reading.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+class KasaStripOutlet(KasaPlug):
+    """One outlet of a KasaStrip.
+
+    raw_data is the outlet's entry in the strip snapshot, so reading any
+    outlet refreshes all of them with a single sysinfo request. Commands
+    carry the outlet's child id and go out through the strip"""
+    __slots__ = ("strip", "child_id", "index")
+
+    def __init__(self, strip, child_id, index, name=None):
+        self.strip = strip
+        self.child_id = child_id
+        self.index = index
+        super().__init__(f"{strip.device_id}:{index}", strip.host,
+                         name or f"{strip.name} {index + 1}")
+
+    @property
+    def sys_info(self):
+        self.strip.sys_info  # refreshes every outlet when stale
+        return self.raw_data
+
+    @property
+    def is_on(self):
+        return self.sys_info.get("state") == 1
+
+    @property
+    def emeter_id(self):
+        return self.child_id
+
+    @property
+    def current_consumption(self):
+        return self.strip.outlet_consumption([self.child_id])[self.child_id]
+
+    def daily_consumption(self, year=None, month=None):
+        if self.has_emeter:
+            return get_emeter_store().get_daily(self.emeter_id, self.host, year, month,
+                                                child_id=self.child_id, kwh=True)
+
+    def monthly_consumption(self, year=None):
+        if self.has_emeter:
+            return get_emeter_store().get_monthly(self.emeter_id, self.host, year,
+                                                  child_id=self.child_id, kwh=True)
+
+    def command_for_state(self, on=None, **state):
+        command = KasaCommand()
+        if on is not None:
+            command.children([self.child_id]).relay(on)
+        return command
+
+    # state lives in the strip, so do results and read backs
+
+    def _apply_results(self, command, results):
+        self.strip._apply_results(command, results)
+
+    def _commanded(self):
+        self.strip._commanded()
+
+    def _send(self, command, timeout=None):
+        return self.strip._send(command, timeout=timeout)
+
+    def invalidate(self):
+        self.strip.invalidate()
+
+    def reboot(self, off_time=DEFAULT_OFF_TIME, timeout=None, countdown=False):
+        """ power cycle this outlet only, see KasaPlug.reboot """
+        self.strip.invalidate()
+        future = run_operation(async_reboot(self.host, off_time, timeout, countdown,
+                                            child_id=self.child_id))
+        future.add_done_callback(self.strip._rebooted)
+        return future
+
+
+class KasaStrip(KasaPlug):
+    """Power strip (HS300, KP303, ...) and its outlets.
+
+    One sysinfo reply carries the state of every outlet, the outlets are
+    KasaStripOutlet devices reading from this snapshot. Switching several
+    outlets is one request per target state using the child_ids context.
+    Turning the strip on / off switches all outlets"""
+    __slots__ = ("outlets",)
+
+    def __init__(self, device_id=None, host=None, name="power strip", raw_data=None,
+                 cache_ttl=DEFAULT_CACHE_TTL):
+        self.outlets = []
+        device_id = device_id or f"KasaStrip:{host}"
+        super().__init__(device_id, host, name, raw_data=raw_data, cache_ttl=cache_ttl)
+
+    def child_id(self, child):
+        # some firmwares only report the outlet index ("00", "01", ...)
+        child_id = child["id"]
+        if len(child_id) <= 2:
+            child_id = f"{self.raw_data.get('deviceId', '')}{child_id}"
+        return child_id
+
+    def update_sysinfo(self, sysinfo, timestamp=None):
+        raw = super().update_sysinfo(sysinfo, timestamp)
+        # outlets are kept and updated in place while the strip reports them
+        outlets = {o.child_id: o for o in self.outlets}
+        self.outlets = []
+        for index, child in enumerate(raw.get("children", [])):
+            outlet = outlets.get(self.child_id(child))
+            if outlet is None:
+                outlet = KasaStripOutlet(self, self.child_id(child), index)
+            if child.get("alias"):
+                outlet.name = child["alias"]
+            outlet.model_info = self.model_info
+            outlet.raw_data = child
+            self.outlets.append(outlet)
+        return raw
+
+    @property
+    def is_on(self):
+        return any(c.get("state") == 1 for c in self.sys_info.get("children", []))
+
+    @property
+    def current_consumption(self):
+        return self.outlet_consumption()
+
+    def outlet_consumption(self, child_ids=None):
+        """{child_id: realtime reading}.
+
+        A strip only meters one outlet per request, they are sent back to
+        back over the pooled connection instead of a connection per outlet"""
+        if child_ids is None:
+            child_ids = [o.child_id for o in self.outlets]
+        pool = get_pool()
+        return {child_id: KasaCommand.parse(pool.query(
+                    self.host, KasaCommand().children([child_id]).add("emeter", "get_realtime").request
+                ))[("emeter", "get_realtime")] for child_id in child_ids}
+
+    def daily_consumption(self, year=None, month=None):
+        """ {day: kWh} summed over all outlets, None without energy meter """
+        if self.has_emeter:
+            return _summed(o.daily_consumption(year, month) for o in self.outlets)
+
+    def monthly_consumption(self, year=None):
+        """ {month: kWh} summed over all outlets, None without energy meter """
+        if self.has_emeter:
+            return _summed(o.monthly_consumption(year) for o in self.outlets)
+
+    def set_outlets(self, states):
+        """ switch several outlets, {outlet or child id: on}, in one request
+        per distinct state instead of one per outlet """
+        by_state = {}
+        for outlet, on in states.items():
+            by_state.setdefault(bool(on), []).append(getattr(outlet, "child_id", outlet))
+        return [self._send(KasaCommand().children(ids).relay(on)) for on, ids in by_state.items()]
+
+    def _apply_results(self, command, results):
+        relay = command.request.get("system", {}).get("set_relay_state")
+        if relay is None:
+            self.invalidate()
+            return
+        child_ids = command.request.get("context", {}).get("child_ids")
+        written = {}
+        for child in self.raw_data.get("children", []):
+            child_id = self.child_id(child)
+            if child_ids is None or child_id in child_ids:
+                child["state"] = written[child_id] = relay["state"]
+        self._written(written)
+
+    def _flat_state(self, sysinfo):
+        return {self.child_id(c): c.get("state") for c in sysinfo.get("children", [])}
+
+
+class KasaBulb(KasaDevice, Bulb):
+    __slots__ = ("_writes",)
+
+    def __init__(self, device_id=None, host=None, name="light bulb", raw_data=None,
+                 cache_ttl=DEFAULT_CACHE_TTL, min_write_interval=DEFAULT_WRITE_INTERVAL):
+        device_id = device_id or f"KasaBulb:{host}"
+        super().__init__(device_id, host, name, raw_data=raw_data, cache_ttl=cache_ttl)
+        self._writes = LatestWins(lambda state: self._send(self.command_for_state(**state)),
+                                  min_interval=min_write_interval, name=self.device_id)
+
+    @property
+    def _bulb(self):
+        """ pyHS100 handle, only created if something needs it """
+        if self._handle is None:
+            self._handle = get_handles().bulb(self.host)
+        return self._handle
+
+    def _light_value(self, key):
+        # while off the device reports the values it will restore in dft_on_state
+        state = self.light_state
+        if not state["on_off"]:
+            state = state["dft_on_state"]
+        return state[key]
+
+    def _capability(self, key):
+        # capabilities never change, any snapshot will do
+        if self.model_info is None:
+            self.refresh()
+        return getattr(self.model_info, key)
+
+    def command_for_state(self, on=None, color=None, brightness=None, color_temp=None):
+        """Batched KasaCommand taking the bulb to the requested state.
+
+        color is a Color or a color name, brightness and color_temp are
+        percentages, capabilities the bulb lacks are skipped"""
+        command = KasaCommand()
+        if color is not None:
+            from lingua_franca.util.colors import Color
+            hsv = None
+            if not isinstance(color, Color):
+                # css3 names come from a precomputed table
+                hsv = name_to_tplink_hsv(color)
+                if hsv is None:
+                    color = Color.from_name(color)
+            if hsv is None:
+                hsv = hsv_to_tplink_hsv(*color.hsv)
+            if hsv[2] == 0:  # black
+                return command.turn_off()
+            # power on and color change go out as one transition
+            command.turn_on()
+            if self.is_color:
+                command.hsv(*hsv)
+        if brightness is not None and self.is_dimmable:
+            command.brightness(brightness)
+        if color_temp is not None and self.is_variable_color_temp:
+            command.color_temp(percent_to_kelvin(self.model, color_temp))
+        if on is not None:
+            command.light_state(on_off=int(bool(on)))
+        return command
+
+    def _apply_results(self, command, results):
+        new_state = results.get((LIGHT_SERVICE, "transition_light_state"))
+        if new_state and "on_off" in new_state:
+            # the reply is the full new light state, keep the snapshot current
+            self.raw_data["light_state"] = new_state
+            sent = command.request[LIGHT_SERVICE]["transition_light_state"]
+            self._written({k: v for k, v in sent.items() if k != "transition_period"})
+        else:
+            self.invalidate()
+
+    def _flat_state(self, sysinfo):
+        # while off the other light values are reported in dft_on_state
+        state = dict(sysinfo.get("light_state", {}))
+        state.update(state.pop("dft_on_state", {}))
+        return state
+
+    @property
+    def as_dict(self):
+        data = super().as_dict
+        data.update({
+            "color": self.color.rgb255,
+            "is_color": self.is_color,
+            "is_dimmable": self.is_dimmable,
+            "is_variable_color_temp": self.is_variable_color_temp,
+            "brightness": self.brightness_255
+        })
+        return data
+
+    @property
+    def color(self):
+        from lingua_franca.util.colors import Color
+        if self.is_off:
+            return Color.from_rgb(0, 0, 0)
+        if self.is_color:
+            h, s, v = tplink_hsv_to_hsv(self._light_value("hue"),
+                                        self._light_value("saturation"),
+                                        self._light_value("brightness"))
+            return Color.from_hsv(h, s, v)
+        return Color.from_rgb(255, 255, 255)
+
+    @property
+    def light_state(self):
+        return self.sys_info["light_state"]
+
+    @property
+    def is_color(self):
+        return self._capability("is_color")
+
+    @property
+    def is_dimmable(self):
+        return self._capability("is_dimmable")
+
+    @property
+    def is_variable_color_temp(self):
+        return self._capability("is_variable_color_temp")
+
+    @property
+    def is_on(self):
+        return bool(self.light_state["on_off"])
+
+    @property
+    def brightness(self):
+        return self._light_value("brightness")
+
+    @property
+    def color_temperatures(self):
+        return self._light_value("color_temp")
+
+    @property
+    def current_consumption(self):
+        return self._bulb.get_emeter_realtime()
+
+    def daily_consumption(self, year=None, month=None):
+        """ {day: kWh}, finished months are served from the local emeter store """
+        return get_emeter_store().get_daily(self.emeter_id, self.host, year, month, bulb=True,
+                                            kwh=True)
+
+    def monthly_consumption(self, year=None):
+        """ {month: kWh}, finished months are served from the local emeter store """
+        return get_emeter_store().get_monthly(self.emeter_id, self.host, year, bulb=True,
+                                              kwh=True)
+
+    @property
+    def write_stats(self):
+        """ submitted / sent / dropped (coalesced away) / failed state writes """
+        return self._writes.stats
+
+    def flush(self):
+        """ send a coalesced state change still waiting for min_write_interval """
+        self._writes.flush()
+
+    # status change, rapid calls are coalesced and only the newest state is sent
+    def turn_on(self):
+        self._writes.submit({"on": True})
+
+    def turn_off(self):
+        self._writes.submit({"on": False})
+
+    def change_brightness(self, value, percent=True):
+        if not percent:
+            raise NotImplementedError
+        self._writes.submit({"brightness": value})
+
+    def change_color_temperatures(self, value, percent=True):
+        if not percent:
+            raise NotImplementedError
+        self._writes.submit({"color_temp": value})
+
+    def change_color(self, name):
+        # setting a color turns the bulb on, cancels a pending turn_off
+        self._writes.submit({"color": name, "on": None})
+
+
+class KasaRGBBulb(KasaBulb, RGBBulb):
+    __slots__ = ()
+
+    def __init__(self, device_id=None, host=None, name="rgb light bulb", raw_data=None,
+                 cache_ttl=DEFAULT_CACHE_TTL, min_write_interval=DEFAULT_WRITE_INTERVAL):
+        device_id = device_id or f"KasaRGBBulb:{host}"
+        super().__init__(device_id, host, name, raw_data=raw_data, cache_ttl=cache_ttl,
+                         min_write_interval=min_write_interval)
+
+
+class KasaRGBWBulb(KasaRGBBulb, RGBWBulb):
+    __slots__ = ()
+
+    def __init__(self, device_id=None, host=None, name="rgbw light bulb", raw_data=None,
+                 cache_ttl=DEFAULT_CACHE_TTL, min_write_interval=DEFAULT_WRITE_INTERVAL):
+        device_id = device_id or f"KasaRGBWBulb:{host}"
+        super().__init__(device_id, host, name, raw_data=raw_data, cache_ttl=cache_ttl,
+                         min_write_interval=min_write_interval)
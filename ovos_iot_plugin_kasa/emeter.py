@@ -0,0 +1,206 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import date
+
+from ovos_iot_plugin_kasa.commands import BULB_EMETER, PLUG_EMETER, KasaCommand
+
+# seconds the current month is served from the store before asking the device again
+DEFAULT_REFRESH_INTERVAL = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily (
+    device TEXT NOT NULL, year INTEGER NOT NULL, month INTEGER NOT NULL,
+    day INTEGER NOT NULL, wh REAL NOT NULL,
+    PRIMARY KEY (device, year, month, day)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS monthly (
+    device TEXT NOT NULL, year INTEGER NOT NULL, month INTEGER NOT NULL,
+    wh REAL NOT NULL,
+    PRIMARY KEY (device, year, month)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS synced (
+    device TEXT NOT NULL, kind TEXT NOT NULL, year INTEGER NOT NULL,
+    month INTEGER NOT NULL, complete INTEGER NOT NULL, ts REAL NOT NULL,
+    PRIMARY KEY (device, kind, year, month)) WITHOUT ROWID;
+"""
+
+
+def _wh(entry):
+    # newer firmware reports energy_wh, older hardware energy in kWh
+    if "energy_wh" in entry:
+        return float(entry["energy_wh"])
+    return float(entry.get("energy", 0)) * 1000
+
+
+def _kwh(values):
+    return {key: wh / 1000 for key, wh in values.items()}
+
+
+def default_store_path():
+    from ovos_utils.xdg_utils import xdg_data_home
+    return os.path.join(xdg_data_home(), "ovos_iot_plugin_kasa", "emeter.db")
+
+
+class EmeterStore:
+    """Local daily / monthly consumption history, in Wh.
+
+    Days and months that are over never change, once synced they are served
+    from the store. Only the running month is fetched from the device, at
+    most once per refresh_interval. Range queries and fleet sums never touch
+    the network"""
+
+    def __init__(self, path=":memory:", refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.refresh_interval = refresh_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    # sync state
+
+    def _synced(self, device, kind, year, month=0):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT complete, ts FROM synced WHERE device=? AND kind=? AND year=? AND month=?",
+                (device, kind, year, month)).fetchone()
+        return row or (0, 0)
+
+    def _mark(self, device, kind, year, month, complete):
+        self._db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?, ?, ?)",
+                         (device, kind, year, month, int(complete), time.time()))
+
+    def _is_fresh(self, device, kind, year, month=0):
+        complete, ts = self._synced(device, kind, year, month)
+        return complete or time.time() - ts < self.refresh_interval
+
+    # recording
+
+    def record_daily(self, device, day_list, year, month, complete=False):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?)",
+                [(device, e["year"], e["month"], e["day"], _wh(e)) for e in day_list])
+            self._mark(device, "daily", year, month, complete)
+
+    def record_monthly(self, device, month_list, year, complete_before=13):
+        """ months before complete_before are final and never fetched again """
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO monthly VALUES (?, ?, ?, ?)",
+                [(device, e["year"], e["month"], _wh(e)) for e in month_list])
+            for month in range(1, complete_before):
+                self._mark(device, "monthly", year, month, True)
+            self._mark(device, "monthly", year, 0, complete_before > 12)
+
+    # local queries
+
+    def daily(self, device, year, month):
+        """ {day: wh} from the store """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day, wh FROM daily WHERE device=? AND year=? AND month=? ORDER BY day",
+                (device, year, month)).fetchall()
+        return dict(rows)
+
+    def monthly(self, device, year):
+        """ {month: wh} from the store """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT month, wh FROM monthly WHERE device=? AND year=? ORDER BY month",
+                (device, year)).fetchall()
+        return dict(rows)
+
+    def range(self, device, start, end):
+        """ [(date, wh)] for the days between start and end (inclusive) """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT year, month, day, wh FROM daily WHERE device=? "
+                "AND year * 10000 + month * 100 + day BETWEEN ? AND ? "
+                "ORDER BY year, month, day",
+                (device, _key(start), _key(end))).fetchall()
+        return [(date(y, m, d), wh) for y, m, d, wh in rows]
+
+    def fleet_total(self, start, end):
+        """ {device: wh} summed over the days between start and end """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT device, SUM(wh) FROM daily "
+                "WHERE year * 10000 + month * 100 + day BETWEEN ? AND ? GROUP BY device",
+                (_key(start), _key(end))).fetchall()
+        return dict(rows)
+
+    def devices(self):
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT DISTINCT device FROM daily")]
+
+    # device sync
+
+    def get_daily(self, device, host, year=None, month=None, bulb=False, today=None,
+                  child_id=None, kwh=False):
+        """ {day: wh} ({day: kWh} with kwh), only asks the device for a running
+        or never synced month
+
+        child_id selects one outlet of a power strip """
+        today = today or date.today()
+        year = year or today.year
+        month = month or today.month
+        if not self._is_fresh(device, "daily", year, month):
+            target = BULB_EMETER if bulb else PLUG_EMETER
+            command = KasaCommand().add(target, "get_daystat", {"year": year, "month": month})
+            if child_id is not None:
+                command.children([child_id])
+            results = command.send(host)
+            day_list = results[(target, "get_daystat")].get("day_list", [])
+            self.record_daily(device, day_list, year, month,
+                              complete=(year, month) < (today.year, today.month))
+        days = self.daily(device, year, month)
+        return _kwh(days) if kwh else days
+
+    def get_monthly(self, device, host, year=None, bulb=False, today=None, child_id=None,
+                    kwh=False):
+        """ {month: wh} ({month: kWh} with kwh), finished months come from the store """
+        today = today or date.today()
+        year = year or today.year
+        if year < today.year:
+            complete_before = 13
+        else:
+            complete_before = today.month
+        done = all(self._synced(device, "monthly", year, m)[0]
+                   for m in range(1, complete_before))
+        if not done:
+            target = BULB_EMETER if bulb else PLUG_EMETER
+            command = KasaCommand().add(target, "get_monthstat", {"year": year})
+            if child_id is not None:
+                command.children([child_id])
+            results = command.send(host)
+            month_list = results[(target, "get_monthstat")].get("month_list", [])
+            self.record_monthly(device, month_list, year, complete_before)
+        months = self.monthly(device, year)
+        if year == today.year:
+            # the running month is the sum of its days, a much smaller request
+            days = self.get_daily(device, host, year, today.month, bulb=bulb, today=today,
+                                  child_id=child_id)
+            months[today.month] = sum(days.values())
+        return _kwh(months) if kwh else months
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _key(day):
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_emeter_store():
+    """ store shared by the kasa.py helpers and device classes, created on first use """
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = EmeterStore(default_store_path())
+    return _STORE
@@ -0,0 +1,125 @@
+import asyncio
+from collections import namedtuple
+from time import monotonic
+
+from ovos_iot_plugin_kasa.aio import async_query, get_engine
+from ovos_iot_plugin_kasa.commands import KasaCommand
+
+# default max requests in flight for a group
+DEFAULT_CONCURRENCY = 16
+# default seconds each device gets to apply its state
+DEFAULT_DEADLINE = 3
+
+# skipped: the device can not do what was asked (e.g. a color for a plug),
+# nothing was sent to it
+DeviceResult = namedtuple("DeviceResult", ["device_id", "host", "ok", "latency", "error", "skipped"],
+                          defaults=(False,))
+
+
+class GroupResult:
+    """ per device outcome of a group / scene change """
+
+    def __init__(self, results, total_time):
+        self.results = results
+        self.total_time = total_time
+
+    @property
+    def ok(self):
+        return all(r.ok for r in self.results)
+
+    @property
+    def succeeded(self):
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self):
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def skipped(self):
+        return [r for r in self.results if r.skipped]
+
+    @property
+    def as_dict(self):
+        return {"total_time": self.total_time,
+                "ok": self.ok,
+                "devices": [r._asdict() for r in self.results]}
+
+
+async def _timed_query(semaphore, host, request, deadline):
+    async with semaphore:
+        start = monotonic()
+        try:
+            reply = await async_query(host, request, timeout=deadline)
+        except Exception as e:
+            return None, monotonic() - start, e
+        return reply, monotonic() - start, None
+
+
+async def _fan_out(jobs, concurrency, deadline):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_timed_query(semaphore, host, request, deadline)
+                                  for host, request in jobs])
+
+
+class KasaGroup:
+    """Applies one state (or a scene of per device states) to many devices.
+
+    Every device gets its batched command in parallel from the shared
+    asyncio engine, at most `concurrency` requests are in flight and each
+    device has `deadline` seconds to answer"""
+
+    def __init__(self, devices, concurrency=DEFAULT_CONCURRENCY, deadline=DEFAULT_DEADLINE):
+        self.devices = list(devices)
+        self.concurrency = concurrency
+        self.deadline = deadline
+
+    def apply_scene(self, scene):
+        """ scene is a list of (device, state dict) pairs, the result has one
+        entry per pair in scene order """
+        start = monotonic()
+        commands = []
+        jobs = []
+        for device, state in scene:
+            command = device.command_for_state(**state)
+            commands.append((device, command))
+            if command:
+                jobs.append((device.host, command.request))
+        replies = iter(get_engine().run(_fan_out(jobs, self.concurrency, self.deadline)))
+        results = []
+        for device, command in commands:
+            if not command:
+                results.append(DeviceResult(device.device_id, device.host, True, 0.0, None,
+                                            skipped=True))
+                continue
+            reply, latency, error = next(replies)
+            if error is None:
+                try:
+                    device._apply_results(command, KasaCommand.parse(reply))
+                    device._commanded()
+                except Exception as e:
+                    error = e
+            if error is not None:
+                device.invalidate()
+            results.append(DeviceResult(device.device_id, device.host, error is None,
+                                        latency, None if error is None else str(error)))
+        return GroupResult(results, monotonic() - start)
+
+    def set_state(self, **state):
+        """ on / color / brightness / color_temp, same state for every device """
+        return self.apply_scene([(device, state) for device in self.devices])
+
+    def turn_on(self):
+        return self.set_state(on=True)
+
+    def turn_off(self):
+        return self.set_state(on=False)
+
+    def change_color(self, color):
+        return self.set_state(color=color)
+
+    def change_brightness(self, value):
+        return self.set_state(brightness=value)
+
+    def change_color_temperatures(self, value):
+        return self.set_state(color_temp=value)
@@ -0,0 +1,119 @@
+"""pyHS100 handles, capabilities and device ids by ip for the kasa.py helpers.
+
+Handles are cheap to keep but not free to build, capabilities (is_color,
+is_dimmable, ...) never change for a device so they are asked for once.
+All are kept in LRUs bounded to max_size ips."""
+import threading
+from collections import OrderedDict
+
+from pyHS100 import SmartPlug, SmartBulb
+
+from ovos_iot_plugin_kasa.models import model_info
+from ovos_iot_plugin_kasa.pool import get_protocol
+
+DEFAULT_MAX_SIZE = 256
+
+
+class HandleRegistry:
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._handles = OrderedDict()  # (ip, kind) -> pyHS100 handle
+        self._models = OrderedDict()  # ip -> ModelInfo
+        self._ids = OrderedDict()  # ip -> deviceId
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {"handles": len(self._handles),
+                    "capabilities": len(self._models),
+                    "hits": self.hits,
+                    "misses": self.misses}
+
+    @staticmethod
+    def _touch(lru, key, value, max_size):
+        # caller holds the lock
+        lru[key] = value
+        lru.move_to_end(key)
+        while len(lru) > max_size:
+            lru.popitem(last=False)
+
+    def _handle(self, ip, kind, factory):
+        key = (ip, kind)
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None:
+                self._handles.move_to_end(key)
+                self.hits += 1
+                return handle
+            self.misses += 1
+        handle = factory(ip, protocol=get_protocol())
+        with self._lock:
+            # another thread may have won, keep the first one
+            handle = self._handles.get(key, handle)
+            self._touch(self._handles, key, handle, self.max_size)
+        return handle
+
+    def plug(self, ip):
+        return self._handle(ip, "plug", SmartPlug)
+
+    def bulb(self, ip):
+        return self._handle(ip, "bulb", SmartBulb)
+
+    def learn(self, ip, info, device_id=None):
+        """ remember the ModelInfo (and deviceId) of an ip, e.g. from a scan """
+        with self._lock:
+            self._touch(self._models, ip, info, self.max_size)
+            if device_id:
+                self._touch(self._ids, ip, device_id, self.max_size)
+
+    def known(self, ip):
+        """ cached ModelInfo of an ip, None if never asked """
+        with self._lock:
+            info = self._models.get(ip)
+            if info is not None:
+                self._models.move_to_end(ip)
+            return info
+
+    def capabilities(self, ip, sysinfo=None):
+        """ ModelInfo of an ip, asks the device once if not known yet """
+        info = self.known(ip)
+        if info is None:
+            if sysinfo is None:
+                from ovos_iot_plugin_kasa.kasa import get_sysinfo
+                sysinfo = get_sysinfo(ip)
+            info = model_info(sysinfo)
+            self.learn(ip, info, sysinfo.get("deviceId"))
+        return info
+
+    def emeter_id(self, ip):
+        """ key of an ip in the emeter store, the deviceId so history survives
+        ip changes and matches the device classes, asks the device once if
+        not known yet """
+        with self._lock:
+            device_id = self._ids.get(ip)
+            if device_id is not None:
+                self._ids.move_to_end(ip)
+                return device_id
+        from ovos_iot_plugin_kasa.kasa import get_sysinfo
+        sysinfo = get_sysinfo(ip)
+        self.learn(ip, model_info(sysinfo), sysinfo.get("deviceId"))
+        return sysinfo.get("deviceId") or ip
+
+    def forget(self, ip):
+        """ drop everything known about an ip, e.g. after it changed device """
+        with self._lock:
+            self._models.pop(ip, None)
+            self._ids.pop(ip, None)
+            for key in [k for k in self._handles if k[0] == ip]:
+                del self._handles[key]
+
+
+_HANDLES = HandleRegistry()
+
+
+def get_handles():
+    """ registry shared by the kasa.py helpers and the plugin """
+    return _HANDLES
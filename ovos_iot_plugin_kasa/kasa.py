@@ -1,7 +1,27 @@
-from pyHS100 import Discover, SmartPlug, SmartBulb
-from time import sleep
+import asyncio
+import json
+import queue
+from pyHS100 import Discover
 from ovos_utils.log import LOG
-from lingua_franca.util.colors import name_to_rgb, rgb_to_name, hex_to_rgb, rgb_to_hsv, hsv_to_rgb, hex_to_hsv, name_to_hsv, hsv_to_name
+from ovos_iot_plugin_kasa import aio
+from ovos_iot_plugin_kasa.aliases import get_alias_index, normalize_alias
+from ovos_iot_plugin_kasa.colors import name_to_tplink_hsv, tplink_hsv_to_name
+from ovos_iot_plugin_kasa.commands import KasaCommand, LIGHT_SERVICE, SYSINFO_QUERY, percent_to_kelvin
+from ovos_iot_plugin_kasa.emeter import get_emeter_store
+from ovos_iot_plugin_kasa.handles import get_handles
+from ovos_iot_plugin_kasa.operations import DEFAULT_OFF_TIME, async_reboot, run_operation
+from ovos_iot_plugin_kasa.pool import get_pool
+
+# keys scan needs from a sysinfo reply, by device type
+REQUIRED_SYSINFO = {
+    "bulb": ("alias", "is_color", "is_dimmable", "is_variable_color_temp", "light_state"),
+    "plug": ("alias", "relay_state"),
+    "strip": ("alias", "children")
+}
+# max requests in flight for the *_many helpers
+DEFAULT_BATCH_CONCURRENCY = 32
+# sysinfo keys that change on their own, ignored when looking for state changes
+VOLATILE_SYSINFO = frozenset(("rssi", "on_time", "heapsize", "err_code", "last_seen"))
 
 
 def discover_devices():
@@ -11,113 +31,204 @@ def discover_devices():
     return devices
 
 
-def find_host_from_device_name(devicename, timeout=3, attempts=3,
-                               return_dev=False):
-    """Discover devices in the network."""
-    LOG.info("Trying to discover %s using %s attempts of %s seconds" %
-             (devicename, attempts, timeout))
-    for attempt in range(1, attempts):
-        LOG.info("Attempt %s of %s" % (attempt, attempts))
-        found_devs = Discover.discover(timeout=timeout).items()
-        for ip, dev in found_devs:
-            if dev.alias.lower() == devicename.lower():
-                if return_dev:
-                    return dev
-                host = dev.host
-                return host
+def device_type(sysinfo):
+    """ "bulb", "plug" or "strip" depending on the reported device type, else None """
+    kind = (sysinfo.get("type") or sysinfo.get("mic_type") or "").lower()
+    if "smartbulb" in kind:
+        return "bulb"
+    if "smartplug" in kind:
+        # power strips (HS300, KP303, ...) report their outlets as children
+        return "strip" if "children" in sysinfo else "plug"
     return None
 
 
-# smart plugs
+def is_complete_sysinfo(sysinfo):
+    """ check that a (possibly truncated) discovery reply has all we need """
+    if not sysinfo:
+        return False
+    kind = device_type(sysinfo)
+    return kind is not None and all(k in sysinfo for k in REQUIRED_SYSINFO[kind])
 
 
-def get_plug_hw_info(ip=None, device=None):
+def sysinfo_fingerprint(sysinfo):
+    """ hash of the sysinfo fields that describe device state and settings """
+    stable = {k: v for k, v in sysinfo.items() if k not in VOLATILE_SYSINFO}
+    if "children" in stable:
+        stable["children"] = [{k: v for k, v in child.items() if k not in VOLATILE_SYSINFO}
+                              for child in stable["children"]]
+    return hash(json.dumps(stable, sort_keys=True))
+
+
+def discover_sysinfo(timeout=3, port=9999, target="255.255.255.255"):
+    """Broadcast a sysinfo request and yield (ip, sysinfo) as devices answer.
+
+    Sync front of aio.async_discover, which runs on the shared engine while
+    its replies are handed over one by one. sysinfo is None if the reply
+    can not be decoded"""
+    replies = queue.Queue()
+
+    async def collect():
+        try:
+            async for reply in aio.async_discover(timeout, port, target):
+                replies.put(reply)
+        finally:
+            replies.put(None)
+
+    future = aio.get_engine().submit(collect())
+    try:
+        for reply in iter(replies.get, None):
+            yield reply
+        future.result()  # raises if discovery itself failed
+    finally:
+        # the caller may stop early
+        future.cancel()
+
+
+def query(host, request, port=9999, timeout=5):
+    """Send a request to a device over a pooled TCP connection and return the
+    decoded reply.
+
+    timeout is a deadline for the whole exchange, not per socket operation"""
+    return get_pool().query(host, request, port=port, timeout=timeout)
+
+
+def get_sysinfo(ip, timeout=5):
+    return query(ip, SYSINFO_QUERY, timeout=timeout)["system"]["get_sysinfo"]
+
+
+def _handle_for(host, kind):
+    if kind == "bulb":
+        return get_handles().bulb(host)
+    return get_handles().plug(host)
+
+
+def _host(ip, device):
     if ip is None and device is None:
         raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
+    return ip if device is None else device.host
+
+
+def _plug(ip, device):
+    """ the given handle, else the cached one for ip """
+    if device is not None:
+        return device
+    if ip is None:
+        raise AttributeError("no device specified")
+    return get_handles().plug(ip)
+
+
+def _bulb(ip, device):
+    """ the given handle, else the cached one for ip """
+    if device is not None:
+        return device
+    if ip is None:
+        raise AttributeError("no device specified")
+    return get_handles().bulb(ip)
+
+
+def _light_state(host):
+    """ light state of a bulb in one request, while off the values it
+    restores when turned on (dft_on_state) are merged in """
+    state = dict(query(host, {LIGHT_SERVICE: {"get_light_state": None}})[LIGHT_SERVICE]["get_light_state"])
+    state.update(state.pop("dft_on_state", {}))
+    return state
+
+
+def _light_hsv(host):
+    """ tplink (h, s, v) of a bulb, the values it restores if it is off """
+    state = _light_state(host)
+    return state["hue"], state["saturation"], state["brightness"]
+
+
+def find_host_from_device_name(devicename, timeout=3, attempts=3,
+                               return_dev=False, fuzzy=False):
+    """Find a device by name (case insensitive).
+
+    Answers from the alias index kept fresh by scans when possible,
+    otherwise discovers devices and returns as soon as the device replies
+    instead of waiting for the discovery timeout. With fuzzy the closest
+    known alias is used if nothing matches exactly, opt in only where
+    acting on a similarly named device is acceptable"""
+    index = get_alias_index()
+    entry = index.resolve(devicename)
+    if entry is None:
+        LOG.info("Trying to discover %s using %s attempts of %s seconds" %
+                 (devicename, attempts, timeout))
+        wanted = normalize_alias(devicename)
+        for attempt in range(attempts):
+            LOG.info("Attempt %s of %s" % (attempt + 1, attempts))
+            for ip, sysinfo in discover_sysinfo(timeout=timeout):
+                if not sysinfo or not sysinfo.get("alias"):
+                    continue
+                index.update(ip, sysinfo["alias"], device_type(sysinfo))
+                if normalize_alias(sysinfo["alias"]) == wanted:
+                    entry = index.resolve(devicename)
+                    break
+            if entry is not None:
+                break
+        else:
+            if fuzzy:
+                entry = index.resolve(devicename, fuzzy=True)
+    if entry is None:
+        return None
+    if return_dev:
+        return _handle_for(entry.host, entry.kind)
+    return entry.host
+
+
+# smart plugs
+
+
+def get_plug_hw_info(ip=None, device=None):
+    plug = _plug(ip, device)
     return plug.hw_info
 
 
 def get_plug_sys_info(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
+    plug = _plug(ip, device)
     return plug.get_sysinfo()
 
 
 def plug_turn_off(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
+    plug = _plug(ip, device)
     return plug.turn_off()
 
 
 def plug_turn_on(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
+    plug = _plug(ip, device)
     return plug.turn_on()
 
 
 def get_plug_state(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
+    plug = _plug(ip, device)
     return plug.state
 
 
 def get_plug_current_consumption(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
+    plug = _plug(ip, device)
     return plug.get_emeter_realtime()
 
 
 def get_plug_daily_consumption(ip=None, device=None, year=None, month=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
-    return plug.get_emeter_daily(year=year, month=month)
+    """ {day: kWh}, finished months are served from the local emeter store,
+    None for plugs without energy meter """
+    host = _host(ip, device)
+    if get_handles().capabilities(host).has_emeter:
+        return get_emeter_store().get_daily(get_handles().emeter_id(host), host, year, month,
+                                            kwh=True)
 
 
 def get_plug_monthly_consumption(ip=None, device=None, year=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
-    return plug.get_emeter_monthly(year=year)
+    """ {month: kWh}, finished months are served from the local emeter store,
+    None for plugs without energy meter """
+    host = _host(ip, device)
+    if get_handles().capabilities(host).has_emeter:
+        return get_emeter_store().get_monthly(get_handles().emeter_id(host), host, year,
+                                              kwh=True)
 
 
 def plug_led(ip=None, device=None, state=True):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
+    plug = _plug(ip, device)
     plug.led = state
 
 
@@ -129,181 +240,122 @@ def plug_led_off(ip=None, device=None):
     plug_led(ip, device, False)
 
 
-def plug_reboot(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        plug = SmartPlug(ip)
-    else:
-        plug = device
-    # TODO Turn off, check state, when off, turn on maybe even with an
-    # optional time to off?
-    plug_turn_off(device=plug)
-    # state = get_plug_state(device=plug)
-    sleep(1)
-    plug_turn_on(device=plug)
+def plug_reboot(ip=None, device=None, off_time=DEFAULT_OFF_TIME, timeout=None, countdown=False,
+                child_id=None):
+    """ power cycle a plug without blocking the caller
+
+    returns a Future resolving to the final sysinfo once the plug is
+    verified on again, cancel it to abort (the plug is switched back on).
+    countdown leaves switching on to the plug itself, see async_reboot.
+    child_id reboots a single power strip outlet"""
+    host = _host(ip, device)
+    return run_operation(async_reboot(host, off_time, timeout, countdown, child_id=child_id))
 
 
 # smart bulbs
 
 
 def get_bulb_hw_info(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
+    bulb = _bulb(ip, device)
     return bulb.hw_info
 
 
 def get_bulb_sys_info(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
+    bulb = _bulb(ip, device)
     return bulb.get_sysinfo()
 
 
 def bulb_turn_off(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
+    bulb = _bulb(ip, device)
     return bulb.turn_off()
 
 
 def bulb_turn_on(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
+    bulb = _bulb(ip, device)
     return bulb.turn_on()
 
 
 def get_bulb_state(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    return bulb.state
+    return "ON" if _light_state(_host(ip, device))["on_off"] else "OFF"
 
 
 def get_bulb_current_consumption(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
+    bulb = _bulb(ip, device)
     return bulb.get_emeter_realtime()
 
 
 def get_bulb_daily_consumption(ip=None, device=None, year=None, month=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    return bulb.get_emeter_daily(year=year, month=month)
+    """ {day: kWh}, finished months are served from the local emeter store """
+    host = _host(ip, device)
+    return get_emeter_store().get_daily(get_handles().emeter_id(host), host, year, month,
+                                        bulb=True, kwh=True)
 
 
 def get_bulb_monthly_consumption(ip=None, device=None, year=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    return bulb.get_emeter_monthly(year=year)
+    """ {month: kWh}, finished months are served from the local emeter store """
+    host = _host(ip, device)
+    return get_emeter_store().get_monthly(get_handles().emeter_id(host), host, year,
+                                          bulb=True, kwh=True)
 
 
 def set_bulb_brightness(ip=None, device=None, percentage=100):
-    percentage = int(percentage)
-    if percentage > 100:
-        percentage = 100
-    if percentage < 0:
-        percentage = 0
-
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    if bulb.is_dimmable:
-        bulb.brightness = percentage
+    percentage = max(0, min(100, int(percentage)))
+    host = _host(ip, device)
+    # capabilities are asked once per ip, the change itself is one request
+    if get_handles().capabilities(host).is_dimmable:
+        KasaCommand().brightness(percentage).send(host)
 
 
 def get_bulb_brightness(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    return bulb.brightness
+    host = _host(ip, device)
+    if get_handles().capabilities(host).is_dimmable:
+        return int(_light_state(host)["brightness"])
 
 
 def set_bulb_color_temperature(ip=None, device=None, value=3000):
-    value = int(value)
-    if value > 100:
-        value = 100
-    if value < 0:
-        value = 0
-
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    if bulb.is_variable_color_temp:
-        bulb.color_temp = value
+    """ value is a percentage of the bulb's kelvin range """
+    value = max(0, min(100, int(value)))
+    host = _host(ip, device)
+    info = get_handles().capabilities(host)
+    if info.is_variable_color_temp:
+        KasaCommand().color_temp(percent_to_kelvin(info.model, value)).send(host)
 
 
 def get_bulb_color_temperature(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    return bulb.color_temp
+    """ kelvin """
+    host = _host(ip, device)
+    if get_handles().capabilities(host).is_variable_color_temp:
+        return int(_light_state(host)["color_temp"])
+
+
+def _tplink_color(hex_color=None, color_name=None):
+    # css3 names come from a precomputed table, anything else goes through lingua_franca
+    hsv = name_to_tplink_hsv(color_name) if hex_color is None else None
+    if hsv is None:
+        from lingua_franca.util.colors import hex_to_hsv, name_to_hsv
+        if hex_color is None:
+            hsv = hsv_to_tplink_hsv(*name_to_hsv(color_name))
+        else:
+            hsv = hsv_to_tplink_hsv(*hex_to_hsv(hex_color))
+    return hsv
 
 
 def set_bulb_color(ip=None, device=None, hex_color=None, color_name=None):
     if hex_color is None and color_name is None:
         raise AttributeError("no color specified")
-    if hex_color is None:
-        h, s, v = name_to_hsv(color_name)
-    else:
-        h, s, v = hex_to_hsv(hex_color)
-    set_bulb_hsv(ip, device, h, s, v)
+    _set_hsv(_host(ip, device), _tplink_color(hex_color, color_name))
     return color_name
 
 
 def set_bulb_hsv(ip=None, device=None, hue=0.5, saturation=1, value=255):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
+    """ set the color of a color bulb, turning it on, other bulbs are left alone """
+    _set_hsv(_host(ip, device), hsv_to_tplink_hsv(hue, saturation, value))
 
-    hue, saturation, value = hsv_to_tplink_hsv(hue, saturation, value)
 
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    if bulb.is_color:
-        bulb.hsv = (hue, saturation, value)
+def _set_hsv(host, hsv):
+    # capabilities are asked once per ip, power on + color is one request
+    if get_handles().capabilities(host).is_color:
+        KasaCommand().turn_on().hsv(*hsv).send(host)
 
 
 def tplink_hsv_to_hsv(h, s, v):
@@ -333,24 +385,111 @@ def hsv_to_tplink_hsv(h, s, v):
 
 
 def get_bulb_hsv(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    if bulb.is_color:
-        return bulb.hsv
+    host = _host(ip, device)
+    if get_handles().capabilities(host).is_color:
+        return _light_hsv(host)
 
 
 def get_bulb_color_name(ip=None, device=None):
-    if ip is None and device is None:
-        raise AttributeError("no device specified")
-    if device is None:
-        bulb = SmartBulb(ip)
-    else:
-        bulb = device
-    if bulb.is_color:
-        h, s, v = bulb.hsv
-        return hsv_to_name(h, s, v)
+    host = _host(ip, device)
+    if get_handles().capabilities(host).is_color:
+        return tplink_hsv_to_name(*_light_hsv(host))
     return "unknown color"
+
+
+# batch variants, one request per ip all in flight at once on the shared
+# engine. Results are {ip: reply}, an ip that failed maps to its exception
+# and a bulb that lacks the capability maps to None
+
+
+async def _gather(ips, make_coro, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(ip):
+        async with semaphore:
+            return await make_coro(ip)
+
+    results = await asyncio.gather(*(one(ip) for ip in ips), return_exceptions=True)
+    return dict(zip(ips, results))
+
+
+def _batch(ips, make_coro, concurrency=DEFAULT_BATCH_CONCURRENCY):
+    ips = list(dict.fromkeys(ips))
+    if not ips:
+        return {}
+    return aio.get_engine().run(_gather(ips, make_coro, concurrency))
+
+
+def _capable(flag, make_coro):
+    """ wrap make_coro so bulbs known to lack flag are not sent anything """
+    handles = get_handles()
+
+    async def run(ip):
+        info = handles.known(ip)
+        if info is None:
+            info = handles.capabilities(ip, await aio.async_get_sysinfo(ip))
+        if not getattr(info, flag):
+            return None
+        return await make_coro(ip, info)
+
+    return run
+
+
+def plug_turn_on_many(ips, timeout=5):
+    return _batch(ips, lambda ip: aio.async_plug_turn_on(ip, timeout=timeout))
+
+
+def plug_turn_off_many(ips, timeout=5):
+    return _batch(ips, lambda ip: aio.async_plug_turn_off(ip, timeout=timeout))
+
+
+def get_plug_state_many(ips, timeout=5):
+    return _batch(ips, lambda ip: aio.async_get_plug_state(ip, timeout=timeout))
+
+
+def get_plug_sys_info_many(ips, timeout=5):
+    return _batch(ips, lambda ip: aio.async_get_sysinfo(ip, timeout=timeout))
+
+
+def plug_led_many(ips, state=True, timeout=5):
+    return _batch(ips, lambda ip: aio.async_plug_led(ip, state, timeout=timeout))
+
+
+def bulb_turn_on_many(ips, timeout=5):
+    return _batch(ips, lambda ip: aio.async_bulb_turn_on(ip, timeout=timeout))
+
+
+def bulb_turn_off_many(ips, timeout=5):
+    return _batch(ips, lambda ip: aio.async_bulb_turn_off(ip, timeout=timeout))
+
+
+def get_bulb_sys_info_many(ips, timeout=5):
+    return _batch(ips, lambda ip: aio.async_get_sysinfo(ip, timeout=timeout))
+
+
+def set_bulb_brightness_many(ips, percentage=100, timeout=5):
+    return _batch(ips, _capable("is_dimmable", lambda ip, info: aio.async_set_bulb_brightness(
+        ip, percentage, timeout=timeout)))
+
+
+def set_bulb_color_temperature_many(ips, value=3000, timeout=5):
+    """ value is a percentage of each bulb's kelvin range """
+    value = max(0, min(100, int(value)))
+    return _batch(ips, _capable("is_variable_color_temp", lambda ip, info: aio.async_set_bulb_color_temperature(
+        ip, percent_to_kelvin(info.model, value), timeout=timeout)))
+
+
+def _set_hsv_many(ips, hsv, timeout):
+    state = {"on_off": 1, "hue": hsv[0], "saturation": hsv[1], "brightness": hsv[2], "color_temp": 0}
+    return _batch(ips, _capable("is_color", lambda ip, info: aio.async_set_light_state(
+        ip, state, timeout=timeout)))
+
+
+def set_bulb_hsv_many(ips, hue=0.5, saturation=1, value=255, timeout=5):
+    return _set_hsv_many(ips, hsv_to_tplink_hsv(hue, saturation, value), timeout)
+
+
+def set_bulb_color_many(ips, hex_color=None, color_name=None, timeout=5):
+    if hex_color is None and color_name is None:
+        raise AttributeError("no color specified")
+    return _set_hsv_many(ips, _tplink_color(hex_color, color_name), timeout)
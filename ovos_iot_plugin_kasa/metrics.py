@@ -0,0 +1,239 @@
+"""Request, discovery and scan metrics.
+
+Every device exchange records its latency into a per-host and a per-command
+histogram plus bytes sent / received, failures are split into timeouts and
+errors. Recording is a lock, a bisect and a few integer adds, cheap enough
+to stay enabled.
+
+    get_metrics().snapshot()    # plain dict
+    get_metrics().prometheus()  # text exposition format
+"""
+import socket
+import threading
+from bisect import bisect_left
+
+# histogram bucket upper bounds in seconds, anything slower lands in +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TIMEOUT_ERRORS = (socket.timeout, TimeoutError)
+
+
+def command_label(request):
+    """ "target.cmd" of every command in a request dict, joined by "+" """
+    if not isinstance(request, dict):
+        return "raw"
+    return "+".join(f"{target}.{cmd}" for target, cmds in request.items()
+                    if target != "context" and isinstance(cmds, dict)
+                    for cmd in cmds) or "empty"
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding the q-th quantile
+
+        None if empty or past the largest bucket, keeps snapshots json safe"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    @property
+    def as_dict(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], self.counts))}
+
+
+class _Counters:
+    __slots__ = ("requests", "timeouts", "errors", "bytes_sent", "bytes_received")
+
+    def __init__(self):
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.by_host = {}
+            self.by_command = {}
+            self.host_counters = {}
+            self.totals = _Counters()
+            self.discovery = {"runs": 0, "replies": 0, "undecodable": 0,
+                              "bytes_received": 0, "last_duration": 0.0}
+            self.discovery_latency = Histogram()
+            self.scan = {"runs": 0, "last_duration": 0.0, "last_devices": 0,
+                         "last_fallbacks": 0, "last_failures": 0, "last_skipped": 0,
+                         "last_unchanged": 0,
+                         "devices_by_type": {}}
+            self.scan_duration = Histogram()
+
+    def _host(self, host):
+        counters = self.host_counters.get(host)
+        if counters is None:
+            counters = self.host_counters[host] = _Counters()
+            self.by_host[host] = Histogram()
+        return counters
+
+    def record_request(self, host, command, latency, sent=0, received=0):
+        """ one successful request / reply exchange """
+        if not self.enabled:
+            return
+        with self._lock:
+            host_counters = self._host(host)
+            self.by_host[host].observe(latency)
+            hist = self.by_command.get(command)
+            if hist is None:
+                hist = self.by_command[command] = Histogram()
+            hist.observe(latency)
+            for counters in (host_counters, self.totals):
+                counters.requests += 1
+                counters.bytes_sent += sent
+                counters.bytes_received += received
+
+    def record_failure(self, host, command, error, sent=0, timeout=None):
+        """ a request that timed out or errored, no latency is recorded """
+        if not self.enabled:
+            return
+        if timeout is None:
+            timeout = isinstance(error, TIMEOUT_ERRORS)
+        with self._lock:
+            for counters in (self._host(host), self.totals):
+                counters.requests += 1
+                counters.bytes_sent += sent
+                if timeout:
+                    counters.timeouts += 1
+                else:
+                    counters.errors += 1
+
+    def record_discovery_reply(self, latency, size, decoded=True):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.discovery["replies"] += 1
+            self.discovery["bytes_received"] += size
+            if not decoded:
+                self.discovery["undecodable"] += 1
+            self.discovery_latency.observe(latency)
+
+    def record_discovery(self, duration):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.discovery["runs"] += 1
+            self.discovery["last_duration"] = duration
+
+    def record_scan(self, duration, devices_by_type, fallbacks=0, failures=0, skipped=0,
+                    unchanged=0):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.scan.update(last_duration=duration,
+                             last_devices=sum(devices_by_type.values()) + unchanged,
+                             last_fallbacks=fallbacks,
+                             last_failures=failures,
+                             last_skipped=skipped,
+                             last_unchanged=unchanged,
+                             devices_by_type=dict(devices_by_type))
+            self.scan["runs"] += 1
+            self.scan_duration.observe(duration)
+
+    def snapshot(self):
+        """ plain dict (json serializable) of everything collected so far """
+        with self._lock:
+            return {
+                "totals": self.totals.as_dict,
+                "hosts": {h: dict(c.as_dict, latency=self.by_host[h].as_dict)
+                          for h, c in self.host_counters.items()},
+                "commands": {c: h.as_dict for c, h in self.by_command.items()},
+                "discovery": dict(self.discovery, latency=self.discovery_latency.as_dict),
+                "scan": dict(self.scan, duration=self.scan_duration.as_dict)
+            }
+
+    def prometheus(self, prefix="kasa"):
+        """ metrics in the prometheus text exposition format """
+        lines = []
+
+        def histogram(name, help_text, hists, label):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for value, hist in hists:
+                labels = f'{label}="{value}",' if label else ""
+                cumulative = 0
+                for bound, n in zip([str(b) for b in BUCKETS] + ["+Inf"], hist.counts):
+                    cumulative += n
+                    lines.append(f'{prefix}_{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                labels = "{" + labels.rstrip(",") + "}" if labels else ""
+                lines.append(f"{prefix}_{name}_sum{labels} {hist.sum}")
+                lines.append(f"{prefix}_{name}_count{labels} {hist.count}")
+
+        def counter(name, help_text, values, kind="counter"):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in values:
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        with self._lock:
+            hosts = sorted(self.host_counters.items())
+            histogram("request_duration_seconds", "Device request round trip time by host.",
+                      [(h, self.by_host[h]) for h, _ in hosts], "host")
+            histogram("command_duration_seconds", "Device request round trip time by command.",
+                      sorted(self.by_command.items()), "command")
+            for field, help_text in (("requests", "Requests sent."),
+                                     ("timeouts", "Requests that timed out."),
+                                     ("errors", "Requests that failed for another reason."),
+                                     ("bytes_sent", "Bytes sent to devices."),
+                                     ("bytes_received", "Bytes received from devices.")):
+                counter(f"{field}_total", help_text,
+                        [(f'{{host="{h}"}}', getattr(c, field)) for h, c in hosts])
+            counter("discovery_replies_total", "Discovery replies received.",
+                    [("", self.discovery["replies"])])
+            counter("discovery_bytes_received_total", "Bytes of discovery replies received.",
+                    [("", self.discovery["bytes_received"])])
+            histogram("discovery_reply_seconds", "Time from discovery broadcast to reply.",
+                      [(None, self.discovery_latency)], None)
+            histogram("scan_duration_seconds", "Duration of a full scan.",
+                      [(None, self.scan_duration)], None)
+            counter("scan_emitted_devices", "New or changed devices emitted by the last scan.",
+                    [(f'{{type="{t}"}}', n) for t, n in sorted(self.scan["devices_by_type"].items())],
+                    kind="gauge")
+        return "\n".join(lines) + "\n"
+
+
+_METRICS = Metrics()
+
+
+def get_metrics():
+    """ metrics shared by the pool, the async engine, discovery and the plugin """
+    return _METRICS
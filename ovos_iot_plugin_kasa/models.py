@@ -0,0 +1,67 @@
+"""Compact sysinfo storage.
+
+A sysinfo reply is ~40 fields, most of them identical for every device of
+the same model and firmware. Those live in one shared, immutable ModelInfo
+per distinct model, devices only keep the few fields that are their own
+(alias, ids and current state)."""
+import threading
+
+from ovos_iot_plugin_kasa.commands import temp_range
+
+# per device sysinfo fields kept on the device, everything else is either
+# shared through ModelInfo or not used by the plugin
+DEVICE_FIELDS = ("alias", "deviceId", "mac", "relay_state", "led_off", "light_state", "children")
+
+_lock = threading.Lock()
+_MODELS = {}
+
+
+class ModelInfo:
+    """ what a model / firmware can do, shared by all devices reporting it """
+    __slots__ = ("model", "hw_ver", "sw_ver", "kind", "dev_name", "is_color", "is_dimmable",
+                 "is_variable_color_temp", "has_emeter", "temp_range")
+
+    def __init__(self, model, hw_ver, sw_ver, kind, dev_name, is_color, is_dimmable,
+                 is_variable_color_temp, has_emeter):
+        self.model = model
+        self.hw_ver = hw_ver
+        self.sw_ver = sw_ver
+        self.kind = kind
+        self.dev_name = dev_name
+        self.is_color = is_color
+        self.is_dimmable = is_dimmable
+        self.is_variable_color_temp = is_variable_color_temp
+        self.has_emeter = has_emeter
+        self.temp_range = temp_range(model) if is_variable_color_temp else None
+
+    @property
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return f"ModelInfo({self.model!r}, {self.hw_ver!r}, {self.sw_ver!r})"
+
+
+def model_info(sysinfo):
+    """ the shared ModelInfo matching a sysinfo reply """
+    kind = (sysinfo.get("type") or sysinfo.get("mic_type") or "").upper()
+    bulb = "SMARTBULB" in kind
+    key = (sysinfo.get("model"), sysinfo.get("hw_ver"), sysinfo.get("sw_ver"), kind,
+           sysinfo.get("dev_name") or sysinfo.get("description"),
+           bool(sysinfo.get("is_color")), bool(sysinfo.get("is_dimmable")),
+           bool(sysinfo.get("is_variable_color_temp")),
+           bulb or "ENE" in sysinfo.get("feature", ""))
+    info = _MODELS.get(key)
+    if info is None:
+        with _lock:
+            info = _MODELS.setdefault(key, ModelInfo(*key))
+    return info
+
+
+def device_state(sysinfo):
+    """ the per device part of a sysinfo reply """
+    return {k: sysinfo[k] for k in DEVICE_FIELDS if k in sysinfo}
+
+
+def known_models():
+    return list(_MODELS.values())
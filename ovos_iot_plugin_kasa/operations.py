@@ -0,0 +1,147 @@
+"""Multi-step device operations bounded by one end-to-end deadline.
+
+Steps run as coroutines on the shared engine, waits between steps are
+asyncio sleeps so no caller thread is blocked, and every request only gets
+what is left of the deadline. Operations are started with run_operation,
+the returned concurrent.futures.Future can be waited on or cancelled.
+
+    op = run_operation(async_reboot("192.168.1.20", off_time=5))
+    ...
+    op.cancel()  # the plug is switched back on
+"""
+import asyncio
+from time import monotonic
+
+from pyHS100 import SmartDeviceException
+
+from ovos_iot_plugin_kasa import aio
+from ovos_iot_plugin_kasa.commands import KasaCommand
+
+# seconds a plug stays off during a reboot
+DEFAULT_OFF_TIME = 1
+# seconds a reboot may take on top of its off time
+DEFAULT_OPERATION_TIMEOUT = 10
+# seconds between state reads while waiting for a device to reach a state
+DEFAULT_POLL_INTERVAL = 0.25
+# name of the count_down rule used by reboots
+COUNTDOWN_RULE = "ovos reboot"
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class StateNotReached(SmartDeviceException):
+    pass
+
+
+class Deadline:
+    """ monotonic point in time shared by every step of an operation """
+    __slots__ = ("at",)
+
+    def __init__(self, timeout):
+        self.at = monotonic() + timeout
+
+    @property
+    def remaining(self):
+        return max(0.0, self.at - monotonic())
+
+    @property
+    def expired(self):
+        return monotonic() >= self.at
+
+    def timeout(self, step="operation"):
+        """ time left for the next request, raises once there is none """
+        remaining = self.remaining
+        if remaining <= 0:
+            raise DeadlineExceeded(f"{step}: deadline exceeded")
+        return remaining
+
+    async def sleep(self, seconds, step="wait"):
+        """ sleep unless that would end past the deadline """
+        if seconds > self.remaining:
+            raise DeadlineExceeded(f"{step}: {seconds}s wait does not fit the deadline")
+        await asyncio.sleep(seconds)
+
+
+def run_operation(coro):
+    """ schedule an operation on the shared engine, returns its Future """
+    return aio.get_engine().submit(coro)
+
+
+async def async_send(host, command, deadline, step="command"):
+    """ send a KasaCommand within the deadline, returns its parsed results """
+    reply = await aio.async_query(host, command.request, timeout=deadline.timeout(step))
+    return KasaCommand.parse(reply)
+
+
+async def async_wait_for(host, check, deadline, step="state", interval=DEFAULT_POLL_INTERVAL):
+    """ read sysinfo until check(sysinfo) holds, returns that sysinfo """
+    while True:
+        sysinfo = await aio.async_get_sysinfo(host, timeout=deadline.timeout(step))
+        if check(sysinfo):
+            return sysinfo
+        if deadline.remaining <= interval:
+            raise StateNotReached(f"{host} {step}: state not reached before the deadline")
+        await asyncio.sleep(interval)
+
+
+def _relay_is(state, child_id=None):
+    def check(sysinfo):
+        if "children" not in sysinfo:
+            return sysinfo.get("relay_state") == state
+        # power strip, one outlet (ids may be reported without the device id) or all
+        children = [c for c in sysinfo["children"]
+                    if child_id is None or child_id.endswith(c["id"])]
+        return bool(children) and all(c.get("state") == state for c in children)
+    return check
+
+
+def _command(child_id=None):
+    command = KasaCommand()
+    if child_id is not None:
+        command.children([child_id])
+    return command
+
+
+async def async_reboot(host, off_time=DEFAULT_OFF_TIME, timeout=None, countdown=False,
+                       interval=DEFAULT_POLL_INTERVAL, child_id=None):
+    """Power cycle a plug: off, verify off, wait off_time, on, verify on.
+
+    With countdown the plug gets a count_down rule in the same request that
+    switches it off, so it turns itself back on even if this process dies
+    or loses the network while it is off. If the operation fails or is
+    cancelled after the off command went out, the plug is switched back on
+    before the error is raised. child_id limits the reboot to one power
+    strip outlet. Returns the final sysinfo"""
+    deadline = Deadline(off_time + (timeout or DEFAULT_OPERATION_TIMEOUT))
+    command = _command(child_id)
+    if countdown:
+        command.add("count_down", "delete_all_rules")
+        command.add("count_down", "add_rule", {"enable": 1, "delay": max(1, round(off_time)),
+                                               "act": 1, "name": COUNTDOWN_RULE})
+    command.relay(False)
+    try:
+        # the off command may have been applied even if its reply is lost
+        await async_send(host, command, deadline, "reboot off")
+        await async_wait_for(host, _relay_is(0, child_id), deadline, "reboot off", interval)
+        await deadline.sleep(off_time, "reboot off time")
+        if not countdown:
+            await async_send(host, _command(child_id).relay(True), deadline, "reboot on")
+        return await async_wait_for(host, _relay_is(1, child_id), deadline, "reboot on", interval)
+    except (asyncio.CancelledError, Exception):
+        await _restore(host, countdown, child_id)
+        raise
+
+
+async def _restore(host, countdown, child_id=None):
+    # a failed or cancelled reboot must not leave the plug off
+    command = _command(child_id)
+    if countdown:
+        command.add("count_down", "delete_all_rules")
+    command.relay(True)
+    try:
+        await async_send(host, command, Deadline(DEFAULT_OPERATION_TIMEOUT), "reboot restore")
+    except Exception:
+        from ovos_utils.log import LOG
+        LOG.exception(f"{host} could not be switched back on after a failed reboot")
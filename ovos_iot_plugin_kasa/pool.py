@@ -0,0 +1,163 @@
+import socket
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from ovos_iot_plugin_kasa.metrics import command_label, get_metrics
+from ovos_iot_plugin_kasa.protocol import HEADER, encrypt, encode_request, decode_response, frame_length
+
+PORT = 9999
+
+
+def _recv_exactly(sock, size, deadline):
+    buf = bytearray()
+    while len(buf) < size:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise socket.timeout("device did not answer in time")
+        sock.settimeout(remaining)
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed by device")
+        buf += chunk
+    return buf
+
+
+class ConnectionPool:
+    """Keeps TCP connections to devices open between requests.
+
+    Idle sockets are kept per (host, port), capped at max_idle in total
+    (least recently used are closed first) and closed after idle_timeout
+    seconds. A reused socket the device has closed in the meantime is
+    replaced by a new connection transparently."""
+
+    def __init__(self, max_idle=64, idle_timeout=30, timeout=5):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = OrderedDict()  # (host, port, fileno) -> (sock, last used)
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+        self.expired = 0
+        self.host_reuses = {}
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {"connects": self.connects,
+                    "reuses": self.reuses,
+                    "reconnects": self.reconnects,
+                    "expired": self.expired,
+                    "idle": len(self._idle),
+                    "host_reuses": dict(self.host_reuses)}
+
+    def _expire(self, now):
+        # caller holds the lock, entries are ordered by last use
+        while self._idle:
+            key, (sock, last_used) = next(iter(self._idle.items()))
+            if len(self._idle) <= self.max_idle and now - last_used < self.idle_timeout:
+                break
+            del self._idle[key]
+            self.expired += 1
+            sock.close()
+
+    def _acquire(self, host, port, timeout):
+        with self._lock:
+            self._expire(monotonic())
+            for key in reversed(self._idle):
+                if key[:2] == (host, port):
+                    sock, _ = self._idle.pop(key)
+                    self.reuses += 1
+                    self.host_reuses[host] = self.host_reuses.get(host, 0) + 1
+                    return sock, True
+            self.connects += 1
+        return socket.create_connection((host, port), timeout=timeout), False
+
+    def _release(self, host, port, sock):
+        with self._lock:
+            self._idle[(host, port, sock.fileno())] = (sock, monotonic())
+            self._expire(monotonic())
+
+    @staticmethod
+    def _exchange(sock, frame, deadline):
+        sock.sendall(frame)
+        length = frame_length(_recv_exactly(sock, HEADER.size, deadline))
+        return _recv_exactly(sock, length, deadline)
+
+    def query_raw(self, host, frame, port=PORT, timeout=None):
+        """ send an encoded frame, return the encrypted reply payload """
+        timeout = timeout or self.timeout
+        deadline = monotonic() + timeout
+        sock, reused = self._acquire(host, port, timeout)
+        try:
+            payload = self._exchange(sock, frame, deadline)
+        except OSError:
+            sock.close()
+            if not reused:
+                raise
+            # the device dropped the idle connection, reconnect once with
+            # what is left of the original deadline
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise socket.timeout(f"{host} deadline exceeded before reconnecting")
+            with self._lock:
+                self.reconnects += 1
+                self.connects += 1
+            sock = socket.create_connection((host, port), timeout=remaining)
+            try:
+                payload = self._exchange(sock, frame, deadline)
+            except OSError:
+                sock.close()
+                raise
+        self._release(host, port, sock)
+        return payload
+
+    def query(self, host, request, port=PORT, timeout=None):
+        """ send a request dict (or json string), return the reply dict """
+        if isinstance(request, str):
+            payload = encrypt(request)
+            frame = HEADER.pack(len(payload)) + payload
+        else:
+            frame = encode_request(request)
+        metrics = get_metrics()
+        start = monotonic()
+        try:
+            reply = self.query_raw(host, frame, port=port, timeout=timeout)
+        except OSError as e:
+            metrics.record_failure(host, command_label(request), e, sent=len(frame))
+            raise
+        metrics.record_request(host, command_label(request), monotonic() - start,
+                               sent=len(frame), received=HEADER.size + len(reply))
+        return decode_response(reply)
+
+    def close(self):
+        with self._lock:
+            for sock, _ in self._idle.values():
+                sock.close()
+            self._idle.clear()
+
+
+class PooledProtocol:
+    """ drop-in for pyHS100's TPLinkSmartHomeProtocol backed by a ConnectionPool """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def query(self, host, request, port=PORT):
+        return self.pool.query(host, request, port=port)
+
+
+_POOL = ConnectionPool()
+_PROTOCOL = PooledProtocol(_POOL)
+
+
+def get_pool():
+    """ connection pool shared by the kasa.py helpers and device classes """
+    return _POOL
+
+
+def get_protocol():
+    """ pyHS100 protocol object using the shared pool """
+    return _PROTOCOL
@@ -0,0 +1,65 @@
+"""Kasa wire format: JSON encrypted with an XOR autokey cipher.
+
+Each cipher byte is the plain byte XOR the previous cipher byte (the first
+one uses the key 171), TCP frames carry a 4 byte big endian length prefix.
+
+Instead of looping over every byte in python the whole message is handled
+as one big integer, decrypting is a single XOR of the ciphertext with itself
+shifted by one byte, encrypting is a prefix XOR done in log2(n) shifts.
+"""
+import json
+import struct
+
+INITIALIZATION_VECTOR = 171
+HEADER = struct.Struct(">I")
+# requested socket receive buffer for discovery replies (the OS may cap it),
+# large fleets answer a broadcast in a burst the default buffer drops
+DISCOVERY_RCVBUF = 4 * 1024 * 1024
+
+
+def encrypt(plaintext):
+    """ cipher bytes for a str / bytes payload, no length prefix """
+    if isinstance(plaintext, str):
+        plaintext = plaintext.encode()
+    n = len(plaintext)
+    if not n:
+        return b""
+    x = int.from_bytes(plaintext, "big")
+    # byte i becomes p[0] ^ ... ^ p[i]
+    shift = 8
+    while shift < 8 * n:
+        x ^= x >> shift
+        shift <<= 1
+    x ^= int.from_bytes(bytes((INITIALIZATION_VECTOR,)) * n, "big")
+    return x.to_bytes(n, "big")
+
+
+def decrypt(ciphertext):
+    """ plain bytes for cipher bytes (bytes, bytearray or memoryview) """
+    n = len(ciphertext)
+    if not n:
+        return b""
+    x = int.from_bytes(ciphertext, "big")
+    # byte i is c[i] ^ c[i - 1], c[-1] being the initialization vector
+    x ^= (INITIALIZATION_VECTOR << 8 * (n - 1)) | (x >> 8)
+    return x.to_bytes(n, "big")
+
+
+def encode_request(request):
+    """ length prefixed TCP frame for a request dict """
+    payload = encrypt(json.dumps(request))
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_datagram(request):
+    """ UDP payload for a request dict, datagrams have no length prefix """
+    return encrypt(json.dumps(request))
+
+
+def decode_response(ciphertext):
+    """ reply dict from cipher bytes (without the length prefix) """
+    return json.loads(decrypt(ciphertext))
+
+
+def frame_length(header):
+    return HEADER.unpack(header)[0]
@@ -0,0 +1,120 @@
+"""Known devices persisted across restarts.
+
+Only what does not change with device state is stored (ids, alias, model
+and capability flags), enough to rebuild usable device objects before the
+first scan. State is always read from the device."""
+import json
+import os
+import tempfile
+import threading
+import time
+
+# sysinfo fields kept in the registry
+REGISTRY_FIELDS = ("alias", "deviceId", "mac", "model", "hw_ver", "sw_ver", "type", "mic_type",
+                   "dev_name", "description", "feature", "is_color", "is_dimmable",
+                   "is_variable_color_temp")
+# seconds a device that was not seen again stays in the registry
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+# last_seen alone only triggers a write once it moved by this many seconds
+LAST_SEEN_RESOLUTION = 3600
+
+
+def default_registry_path():
+    from ovos_utils.xdg_utils import xdg_data_home
+    return os.path.join(xdg_data_home(), "ovos_iot_plugin_kasa", "devices.json")
+
+
+class DeviceRegistry:
+    def __init__(self, path=None, max_age=DEFAULT_MAX_AGE):
+        self.path = path or default_registry_path()
+        self.max_age = max_age
+        self._devices = {}  # host -> entry
+        self._hosts_by_id = {}  # deviceId -> host
+        self._changes = 0  # bumped by every change worth writing
+        self._saved = 0  # _changes when the file was last written
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, host):
+        return host in self._devices
+
+    def load(self):
+        """ read the registry file, entries older than max_age are dropped """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            self._devices = {host: entry for host, entry in data.get("devices", {}).items()
+                             if entry.get("last_seen", 0) >= cutoff}
+            self._hosts_by_id = {e["deviceId"]: h for h, e in self._devices.items()
+                                 if e.get("deviceId")}
+        return self
+
+    def save(self):
+        """ write the registry if it changed, atomically replacing the old file """
+        with self._save_lock:
+            self._save()
+
+    def _save(self):
+        # caller holds _save_lock, so the newest snapshot is also written last
+        with self._lock:
+            if self._changes == self._saved:
+                return
+            data = {"version": 1, "devices": dict(self._devices)}
+            changes = self._changes
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # a unique temp file also keeps other processes saving to the same path apart
+        fd, tmp = tempfile.mkstemp(prefix=".devices-", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        # only now, a failed write is retried by the next save
+        with self._lock:
+            self._saved = changes
+
+    def record(self, host, sysinfo, last_seen=None):
+        entry = {k: sysinfo[k] for k in REGISTRY_FIELDS if k in sysinfo}
+        if "children" in sysinfo:
+            # power strip outlets, without their state
+            entry["children"] = [{"id": c["id"], "alias": c.get("alias")}
+                                 for c in sysinfo["children"]]
+        entry["last_seen"] = last_seen or time.time()
+        with self._lock:
+            old = self._devices.get(host)
+            if old is None or {**old, "last_seen": 0} != {**entry, "last_seen": 0} or \
+                    entry["last_seen"] - old.get("last_seen", 0) > LAST_SEEN_RESOLUTION:
+                self._changes += 1
+            self._devices[host] = entry
+            # a device that moved to another ip is only kept under the new one
+            device_id = entry.get("deviceId")
+            if device_id:
+                other = self._hosts_by_id.get(device_id)
+                if other is not None and other != host and \
+                        self._devices.get(other, {}).get("deviceId") == device_id:
+                    del self._devices[other]
+                    self._changes += 1
+                self._hosts_by_id[device_id] = host
+
+    def remove(self, host):
+        with self._lock:
+            if self._devices.pop(host, None) is not None:
+                self._changes += 1
+
+    def sysinfo(self, host):
+        """ the stored fields of a host, shaped like a (partial) sysinfo reply """
+        entry = self._devices.get(host)
+        return dict(entry) if entry is not None else None
+
+    def hosts(self):
+        return list(self._devices)
@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import time
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from ovos_utils.log import LOG
+
+from ovos_iot_plugin_kasa.aio import async_get_emeter_realtime, get_engine
+
+FIELDS = ("ts", "power", "voltage", "current", "total")
+Sample = namedtuple("Sample", FIELDS)
+
+
+def normalize_realtime(reading):
+    """ (W, V, A, Wh) from either the new (milli-units) or old reply format """
+    if "power_mw" in reading:
+        return (reading.get("power_mw", 0) / 1000, reading.get("voltage_mv", 0) / 1000,
+                reading.get("current_ma", 0) / 1000, float(reading.get("total_wh", 0)))
+    return (float(reading.get("power", 0)), float(reading.get("voltage", 0)),
+            float(reading.get("current", 0)), reading.get("total", 0) * 1000)
+
+
+class RingBuffer:
+    """Fixed size store of samples, one array('d') per field.
+
+    The oldest sample is overwritten once full, memory use is constant at
+    size * 5 doubles no matter how long the sampler runs"""
+
+    def __init__(self, size):
+        self.size = size
+        self._columns = [array("d", bytes(8 * size)) for _ in FIELDS]
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values):
+        with self._lock:
+            for column, value in zip(self._columns, values):
+                column[self._next] = value
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def _indexes(self):
+        start = (self._next - self._count) % self.size
+        return [(start + i) % self.size for i in range(self._count)]
+
+    def __iter__(self):
+        """ samples from oldest to newest """
+        with self._lock:
+            rows = [Sample(*(c[i] for c in self._columns)) for i in self._indexes()]
+        return iter(rows)
+
+    def latest(self):
+        with self._lock:
+            if not self._count:
+                return None
+            i = (self._next - 1) % self.size
+            return Sample(*(c[i] for c in self._columns))
+
+    def column(self, field):
+        """ array('d') copy of one field, oldest to newest """
+        col = self._columns[FIELDS.index(field)]
+        with self._lock:
+            return array("d", (col[i] for i in self._indexes()))
+
+
+class _Jitter:
+    __slots__ = ("count", "total", "max", "failures")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.failures = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def as_dict(self):
+        return {"mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "samples": self.count,
+                "failures": self.failures}
+
+
+class EmeterSampler:
+    """Polls get_realtime on many devices concurrently at a fixed rate.
+
+    Ticks are scheduled from the start time (tick n fires at start + n *
+    interval) so slow replies never shift the schedule; ticks that can not
+    be served because the previous one overran are skipped and counted.
+    Jitter is how late each device's request was sent relative to its tick.
+    Subscribers are called in order from one worker thread, a slow or
+    failing callback never holds up sampling or the shared engine"""
+
+    def __init__(self, interval=1.0, buffer_size=3600, timeout=None):
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.timeout = timeout or interval
+        self.buffers = {}
+        self._devices = {}  # device_id -> (host, bulb, child_id)
+        self._jitter = {}
+        self._callbacks = []
+        self._dispatcher = None  # ThreadPoolExecutor running the callbacks
+        self._future = None
+        self.ticks = 0
+        self.missed_ticks = 0
+
+    def add_device(self, device_id, host, bulb=False, child_id=None):
+        """ child_id selects one outlet of a power strip """
+        self._devices[device_id] = (host, bulb, child_id)
+        self.buffers.setdefault(device_id, RingBuffer(self.buffer_size))
+        self._jitter.setdefault(device_id, _Jitter())
+
+    def remove_device(self, device_id):
+        self._devices.pop(device_id, None)
+
+    def subscribe(self, callback):
+        """ callback(device_id, Sample) for every new sample """
+        self._callbacks.append(callback)
+
+    def samples(self, device_id):
+        """ iterate the buffered samples of a device, oldest first """
+        return iter(self.buffers[device_id])
+
+    @property
+    def stats(self):
+        return {"ticks": self.ticks,
+                "missed_ticks": self.missed_ticks,
+                "jitter": {d: j.as_dict for d, j in self._jitter.items()}}
+
+    def _dispatch(self, device_id, sample):
+        for callback in list(self._callbacks):
+            try:
+                callback(device_id, sample)
+            except Exception:
+                LOG.exception(f"emeter sample callback {callback} failed for {device_id}")
+
+    async def _sample(self, device_id, host, bulb, child_id, tick_time, loop):
+        sent = loop.time()
+        try:
+            reading = await async_get_emeter_realtime(host, bulb=bulb, timeout=self.timeout,
+                                                      child_id=child_id)
+        except Exception:
+            self._jitter[device_id].failures += 1
+            return
+        self._jitter[device_id].add(sent - tick_time)
+        sample = (time.time(),) + normalize_realtime(reading)
+        self.buffers[device_id].append(sample)
+        dispatcher = self._dispatcher
+        if self._callbacks and dispatcher is not None:
+            try:
+                dispatcher.submit(self._dispatch, device_id, Sample(*sample))
+            except RuntimeError:
+                pass  # stopped while the reply was in flight
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tick = 0
+        while True:
+            tick_time = start + tick * self.interval
+            delay = tick_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await asyncio.gather(*[self._sample(d, host, bulb, child_id, tick_time, loop)
+                                   for d, (host, bulb, child_id) in list(self._devices.items())])
+            self.ticks += 1
+            # drop ticks the last round overran instead of firing them late
+            next_tick = int((loop.time() - start) // self.interval) + 1
+            self.missed_ticks += max(0, next_tick - tick - 1)
+            tick = max(tick + 1, next_tick)
+
+    @property
+    def running(self):
+        return self._future is not None and not self._future.done()
+
+    def start(self):
+        if not self.running:
+            if self._dispatcher is None:
+                self._dispatcher = ThreadPoolExecutor(1, thread_name_prefix="EmeterSampler")
+            self._future = get_engine().submit(self._run())
+
+    def stop(self):
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+        if self._dispatcher is not None:
+            # callbacks already queued still run
+            self._dispatcher.shutdown(wait=False)
+            self._dispatcher = None
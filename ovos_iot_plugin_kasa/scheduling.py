@@ -0,0 +1,68 @@
+"""Scan interval and per-host retry scheduling."""
+import random
+from time import monotonic
+
+
+class AdaptiveInterval:
+    """Scan interval that grows while nothing changes.
+
+    Every scan that finds the same devices as the previous one multiplies the
+    interval by factor up to maximum, any change drops it back to minimum so
+    new devices are picked up at the fast rate again"""
+
+    def __init__(self, minimum=15, maximum=60, factor=2):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.factor = factor
+        self.value = minimum
+
+    def update(self, changed):
+        if changed:
+            self.value = self.minimum
+        else:
+            self.value = min(self.maximum, self.value * self.factor)
+        return self.value
+
+    def reset(self):
+        self.value = self.minimum
+
+
+class Backoff:
+    """Exponential backoff with jitter per host.
+
+    After n consecutive failures a host is skipped for a random delay between
+    half and all of min(cap, base * 2 ** (n - 1)) seconds, the jitter keeps
+    hosts that failed together from being retried together"""
+
+    def __init__(self, base=5, cap=300):
+        self.base = base
+        self.cap = cap
+        self._hosts = {}  # host -> (consecutive failures, retry at)
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def failure(self, host):
+        """ register a failure, returns seconds until the host is tried again """
+        failures = self._hosts.get(host, (0, 0))[0] + 1
+        delay = min(self.cap, self.base * 2 ** (failures - 1))
+        delay = delay / 2 + random.random() * delay / 2
+        self._hosts[host] = (failures, monotonic() + delay)
+        return delay
+
+    def success(self, host):
+        self._hosts.pop(host, None)
+
+    def ready(self, host):
+        """ False while the host is backing off """
+        entry = self._hosts.get(host)
+        return entry is None or monotonic() >= entry[1]
+
+    def failures(self, host):
+        return self._hosts.get(host, (0, 0))[0]
+
+    @property
+    def as_dict(self):
+        now = monotonic()
+        return {host: {"failures": n, "retry_in": max(0.0, at - now)}
+                for host, (n, at) in self._hosts.items()}
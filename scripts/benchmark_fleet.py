@@ -0,0 +1,114 @@
+"""Scaling benchmark against a simulated Kasa fleet on loopback.
+
+    python scripts/benchmark_fleet.py --sizes 10 100 500 --latency 0.01
+
+Reports, per fleet size, scan time, get_device / helper / group latency
+percentiles and how many TCP connections and requests the devices saw.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+from ovos_utils.messagebus import FakeBus
+
+from ovos_iot_plugin_kasa import KasaPlugin
+from ovos_iot_plugin_kasa.kasa import get_plug_sys_info, plug_turn_on, set_bulb_brightness
+from ovos_iot_plugin_kasa.pool import get_pool
+
+# the simulator lives with the tests, it is not part of the installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.simulator import KasaSimulator  # noqa: E402
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def pick(p):
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+    return {"p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99),
+            "max_ms": round(samples[-1] * 1000, 3)}
+
+
+def timed(func, *args, **kwargs):
+    start = time.monotonic()
+    func(*args, **kwargs)
+    return time.monotonic() - start
+
+
+def bench(size, latency, loss, unresponsive, discovery_timeout):
+    third = size // 3
+    sim = KasaSimulator.fleet(plugs=size - 2 * third, bulbs=third, color_bulbs=third,
+                              latency=latency, loss=loss, unresponsive=unresponsive)
+    report = {"size": size}
+    with sim:
+        plugin = KasaPlugin(FakeBus(), config={"registry": False})
+        plugin.config.update({"discovery_target": sim.discovery_host,
+                              "discovery_timeout": discovery_timeout})
+
+        # scan
+        start = time.monotonic()
+        first = None
+        devices = []
+        for device in plugin.scan():
+            first = first or time.monotonic() - start
+            devices.append(device)
+        report["scan"] = {"total_s": round(time.monotonic() - start, 3),
+                          "first_device_s": round(first or 0, 3),
+                          "found": len(devices), **sim.stats}
+        sim.reset_stats()
+
+        hosts = [d.host for d in devices]
+        plugs = [d.host for d in devices if d.__class__.__name__ == "KasaPlug"]
+        bulbs = [d.host for d in devices if d.__class__.__name__ != "KasaPlug"]
+
+        # get_device, indexed and with a cold index
+        report["get_device_indexed"] = percentiles([timed(plugin.get_device, h) for h in hosts])
+        cold = KasaPlugin(FakeBus(), config={"registry": False})
+        report["get_device_cold"] = percentiles([timed(cold.get_device, h) for h in hosts])
+
+        # kasa.py helpers
+        report["get_plug_sys_info"] = percentiles([timed(get_plug_sys_info, h) for h in plugs])
+        report["plug_turn_on"] = percentiles([timed(plug_turn_on, h) for h in plugs])
+        report["set_bulb_brightness"] = percentiles(
+            [timed(set_bulb_brightness, h, percentage=50) for h in bulbs])
+
+        # group fan-out
+        result = plugin.group(devices).change_color("red")
+        report["group_change_color"] = {"total_s": round(result.total_time, 3),
+                                        "failed": len(result.failed),
+                                        **percentiles([r.latency for r in result.results])}
+        report["devices"] = sim.stats
+        report["pool"] = {k: v for k, v in get_pool().stats.items() if k != "host_reuses"}
+    get_pool().close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="simulated device reply latency in seconds")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="probability a device drops a request")
+    parser.add_argument("--unresponsive", type=int, default=0,
+                        help="number of devices that never answer")
+    parser.add_argument("--discovery-timeout", type=float, default=1.0)
+    args = parser.parse_args()
+
+    # every virtual device needs a tcp and an udp socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, 8 * max(args.sizes))), hard))
+
+    for size in args.sizes:
+        print(json.dumps(bench(size, args.latency, args.loss, args.unresponsive,
+                               args.discovery_timeout), indent=2))
+
+
+if __name__ == "__main__":
+    main()
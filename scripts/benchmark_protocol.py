@@ -0,0 +1,89 @@
+"""Cipher micro-benchmark against pyHS100's TPLinkSmartHomeProtocol.
+
+    python scripts/benchmark_protocol.py --repeat 200
+
+Checks that protocol.encrypt / decrypt produce byte-identical output to
+pyHS100 for every payload length up to --verify-max, then reports the
+time per call of both implementations for payloads from a bare sysinfo
+request to a large emeter history reply. Exits non-zero on any mismatch.
+"""
+import argparse
+import json
+import random
+import sys
+import timeit
+
+from pyHS100 import TPLinkSmartHomeProtocol
+
+from ovos_iot_plugin_kasa.protocol import HEADER, encrypt, decrypt
+
+# an HS110 sysinfo reply
+SYSINFO = {
+    "sw_ver": "1.5.4 Build 180815 Rel.121440", "hw_ver": "2.0", "type": "IOT.SMARTPLUGSWITCH",
+    "model": "HS110(EU)", "dev_name": "Smart Wi-Fi Plug With Energy Monitoring", "icon_hash": "",
+    "relay_state": 1, "on_time": 3600, "active_mode": "none", "feature": "TIM:ENE", "updating": 0,
+    "rssi": -60, "led_off": 0, "latitude_i": 0, "longitude_i": 0, "alias": "kitchen plug",
+    "mac": "50:C7:BF:00:01:01", "deviceId": "50C7BF000101" * 3, "hwId": "0" * 32, "err_code": 0
+}
+
+
+def payloads():
+    day_list = [{"year": 2024, "month": 1, "day": d, "energy_wh": 100 + d} for d in range(1, 32)]
+    return {
+        "sysinfo_request": json.dumps({"system": {"get_sysinfo": None}}),
+        "sysinfo_reply": json.dumps({"system": {"get_sysinfo": SYSINFO}}),
+        "daystat_reply": json.dumps({"emeter": {"get_daystat": {"day_list": day_list}}}),
+        "large_reply": json.dumps({"emeter": {"get_daystat": {"day_list": day_list * 40}}}),
+    }
+
+
+def verify(max_length, seed=0):
+    """ compare both implementations on random ascii payloads, returns mismatched lengths """
+    rng = random.Random(seed)
+    mismatches = []
+    for length in range(max_length + 1):
+        plain = "".join(chr(rng.randrange(32, 127)) for _ in range(length))
+        theirs = TPLinkSmartHomeProtocol.encrypt(plain)[HEADER.size:]
+        ours = encrypt(plain)
+        if ours != theirs or decrypt(ours) != TPLinkSmartHomeProtocol.decrypt(theirs).encode():
+            mismatches.append(length)
+    return mismatches
+
+
+def per_call_us(func, arg, repeat):
+    return round(min(timeit.repeat(lambda: func(arg), number=repeat, repeat=3)) / repeat * 1e6, 2)
+
+
+def bench(plain, repeat):
+    cipher = encrypt(plain)
+    if TPLinkSmartHomeProtocol.encrypt(plain)[HEADER.size:] != cipher or \
+            decrypt(cipher).decode() != TPLinkSmartHomeProtocol.decrypt(cipher):
+        raise AssertionError(f"output differs from pyHS100 for a {len(plain)} byte payload")
+    result = {"bytes": len(plain),
+              "encrypt_us": per_call_us(encrypt, plain, repeat),
+              "pyhs100_encrypt_us": per_call_us(TPLinkSmartHomeProtocol.encrypt, plain, repeat),
+              "decrypt_us": per_call_us(decrypt, cipher, repeat),
+              "pyhs100_decrypt_us": per_call_us(TPLinkSmartHomeProtocol.decrypt, cipher, repeat)}
+    result["encrypt_speedup"] = round(result["pyhs100_encrypt_us"] / max(result["encrypt_us"], 0.01), 1)
+    result["decrypt_speedup"] = round(result["pyhs100_decrypt_us"] / max(result["decrypt_us"], 0.01), 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--verify-max", type=int, default=2048,
+                        help="check every payload length from 0 up to this")
+    args = parser.parse_args()
+
+    mismatches = verify(args.verify_max)
+    report = {"verified_lengths": args.verify_max + 1,
+              "mismatched_lengths": mismatches[:20],
+              "payloads": {name: bench(plain, args.repeat) for name, plain in payloads().items()}}
+    print(json.dumps(report, indent=2))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Fail if importing the plugin entry point gets slow or pulls in heavy modules.
+
+    python scripts/check_import_time.py --budget-ms 300
+
+Runs the import in fresh interpreters with -X importtime, compares the best
+cumulative time of ovos_iot_plugin_kasa against the budget and checks that
+the modules deferred to the first scan / color operation were not loaded.
+"""
+import argparse
+import subprocess
+import sys
+
+ENTRY_POINT = "import ovos_iot_plugin_kasa; ovos_iot_plugin_kasa.KasaPlugin"
+DEFERRED = ("pyHS100", "lingua_franca", "ovos_utils.log", "ovos_PHAL_plugin_commonIOT.opm.lights",
+            "ovos_iot_plugin_kasa.devices", "ovos_iot_plugin_kasa.kasa", "ovos_iot_plugin_kasa.aio")
+
+
+def import_times():
+    """ {module: (self_us, cumulative_us)} for one fresh import of the entry point """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", ENTRY_POINT],
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=300.0,
+                        help="max cumulative import time of the plugin package")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="fresh interpreters to try, the fastest one counts")
+    parser.add_argument("--top", type=int, default=10,
+                        help="slowest imports to list")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    best = min(runs, key=lambda t: t["ovos_iot_plugin_kasa"][1])
+    total_ms = best["ovos_iot_plugin_kasa"][1] / 1000
+
+    print(f"ovos_iot_plugin_kasa: {total_ms:.1f} ms (budget {args.budget_ms:.1f} ms)")
+    for name, (self_us, _) in sorted(best.items(), key=lambda i: -i[1][0])[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    loaded = [m for m in DEFERRED if m in best]
+    if loaded:
+        print(f"loaded at import time, should be deferred: {', '.join(loaded)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print("import time over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Memory used per device object and allocation churn across scans.
+
+    python scripts/measure_memory.py --devices 500 --scans 10
+
+Builds devices from simulated sysinfo replies (no network needed) the same
+way scan does, reports traced bytes per device after the first scan and
+how many device objects / bytes each later scan allocates when every
+device reports a state change.
+
+Peak tracking per scan uses tracemalloc.reset_peak (Python 3.9+). On 3.8
+tracing is restarted instead, objects freed from earlier scans are then
+not subtracted so the peak figure is an upper bound.
+"""
+import argparse
+import gc
+import ipaddress
+import json
+import os
+import sys
+import tracemalloc
+
+from ovos_utils.messagebus import FakeBus
+
+from ovos_iot_plugin_kasa import KasaPlugin
+
+# the simulator lives with the tests, it is not part of the installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.simulator import VirtualDevice  # noqa: E402
+
+
+def fleet_sysinfo(size, base="127.0.1.1"):
+    start = ipaddress.ip_address(base)
+    kinds = ("plug", "bulb", "color_bulb")
+    return [VirtualDevice(str(start + i), kinds[i % 3]) for i in range(size)]
+
+
+def toggle(device):
+    # a state change so the next scan has to update every device
+    if device.kind == "plug":
+        device.sysinfo["relay_state"] ^= 1
+    else:
+        device.sysinfo["light_state"]["brightness"] = 1 + device.sysinfo["light_state"]["brightness"] % 100
+
+
+def reset_peak():
+    # tracemalloc.reset_peak is Python 3.9+, restarting tracing also resets the peak
+    # but forgets earlier allocations, frees of those no longer lower the count
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+def scan(plugin, virtual):
+    return [plugin._scanned_device(d.host, dict(d.sysinfo)) for d in virtual]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--scans", type=int, default=10)
+    args = parser.parse_args()
+
+    virtual = fleet_sysinfo(args.devices)
+    plugin = KasaPlugin(FakeBus(), config={"registry": False})
+    scan(plugin, virtual[:3])  # warm up lazy imports and shared tables
+    plugin._devices.clear()
+    plugin._fingerprints.clear()
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    scan(plugin, virtual)
+    gc.collect()
+    first = tracemalloc.get_traced_memory()[0] - before
+    ids = {host: id(device) for host, device in plugin._devices.items()}
+
+    reallocated = 0
+    churn = 0
+    collections = sum(s["collections"] for s in gc.get_stats())
+    for _ in range(args.scans):
+        for device in virtual:
+            toggle(device)
+        reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        scan(plugin, virtual)
+        churn += tracemalloc.get_traced_memory()[1] - start
+        reallocated += sum(id(d) != ids[h] for h, d in plugin._devices.items())
+        ids = {host: id(device) for host, device in plugin._devices.items()}
+    collections = sum(s["collections"] for s in gc.get_stats()) - collections
+    tracemalloc.stop()
+
+    print(json.dumps({
+        "devices": args.devices,
+        "bytes_per_device": round(first / args.devices),
+        "scans": args.scans,
+        "objects_reallocated_per_scan": reallocated / args.scans,
+        "peak_bytes_allocated_per_scan": round(churn / args.scans),
+        "gc_collections": collections
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+from ovos_utils.messagebus import FakeBus
+
+from ovos_iot_plugin_kasa import KasaPlugin
+from tests.simulator import KasaSimulator
+
+
+def wait_until(check, timeout=3.0, interval=0.02):
+    """ poll check() until it holds, returns its last value """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result or time.monotonic() >= deadline:
+            return result
+        time.sleep(interval)
+
+
+async def _cancel_pending():
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.fixture
+def fleet():
+    """ start a simulated fleet, fleet(plugs=2, bulbs=1, ...) returns the simulator
+
+    everything the plugin remembers per ip (pooled connections, capabilities,
+    aliases) is dropped afterwards, the next test reuses the same addresses"""
+    from ovos_iot_plugin_kasa.aio import get_engine
+    from ovos_iot_plugin_kasa.aliases import get_alias_index
+    from ovos_iot_plugin_kasa.handles import get_handles
+    from ovos_iot_plugin_kasa.pool import get_pool
+    started = []
+
+    def start(**kwargs):
+        kwargs.setdefault("discovery_spread", 0.05)
+        sim = KasaSimulator.fleet(**kwargs)
+        sim.start()
+        started.append(sim)
+        return sim
+
+    yield start
+    # read backs still waiting on the shared engine would hit the next fleet
+    get_engine().run(_cancel_pending())
+    get_pool().close()
+    for sim in started:
+        sim.stop()
+        for host in sim.hosts:
+            get_handles().forget(host)
+            get_alias_index().remove(host)
+
+
+@pytest.fixture
+def make_plugin():
+    """ KasaPlugin scanning a simulator, make_plugin(sim, **config) """
+
+    def make(sim, **config):
+        config = {"registry": False, "discovery_target": sim.discovery_host,
+                  "discovery_timeout": 0.5, "sysinfo_timeout": 0.5, **config}
+        return KasaPlugin(FakeBus(), config=config)
+
+    return make
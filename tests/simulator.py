@@ -0,0 +1,359 @@
+"""Simulated Kasa devices speaking the real UDP discovery / TCP 9999 protocol.
+
+Every virtual device listens on its own loopback address (127.0.1.1,
+127.0.1.2, ...) so the plugin talks to it exactly like to real hardware,
+discovery requests sent to the simulator's discovery address are answered
+by every device from its own address. Needs an OS routing all of 127/8 to
+loopback (linux does). Used by the tests and the benchmark scripts, it is
+not part of the installed package.
+
+    sim = KasaSimulator.fleet(plugs=10, bulbs=10, color_bulbs=10, latency=0.01)
+    sim.start()
+    ...  # KasaPlugin with config {"discovery_target": sim.discovery_host}
+    sim.stop()
+"""
+import asyncio
+import copy
+import ipaddress
+import json
+import random
+import threading
+import time
+
+from ovos_iot_plugin_kasa.protocol import HEADER, decode_response, encode_datagram, encrypt
+
+LIGHT_SERVICE = "smartlife.iot.smartbulb.lightingservice"
+EMETERS = ("emeter", "smartlife.iot.common.emeter")
+
+PLUG_SYSINFO = {
+    "sw_ver": "1.5.4 Build 180815 Rel.121440", "hw_ver": "2.0", "type": "IOT.SMARTPLUGSWITCH",
+    "model": "HS110(EU)", "dev_name": "Smart Wi-Fi Plug With Energy Monitoring",
+    "icon_hash": "", "relay_state": 0, "on_time": 0, "active_mode": "none",
+    "feature": "TIM:ENE", "updating": 0, "rssi": -60, "led_off": 0, "latitude_i": 0,
+    "longitude_i": 0, "err_code": 0
+}
+BULB_SYSINFO = {
+    "sw_ver": "1.8.6 Build 180809 Rel.091659", "hw_ver": "1.0", "mic_type": "IOT.SMARTBULB",
+    "model": "LB120(EU)", "description": "Smart Wi-Fi LED Bulb with Tunable White Light",
+    "dev_state": "normal", "is_factory": False, "disco_ver": "1.0", "ctrl_protocols": {},
+    "light_state": {"on_off": 1, "mode": "normal", "hue": 0, "saturation": 0,
+                    "color_temp": 2700, "brightness": 100},
+    "is_dimmable": 1, "is_color": 0, "is_variable_color_temp": 1, "preferred_state": [],
+    "rssi": -60, "active_mode": "none", "heapsize": 290784, "err_code": 0
+}
+STRIP_SYSINFO = {
+    "sw_ver": "1.0.6 Build 200821 Rel.090909", "hw_ver": "1.0", "mic_type": "IOT.SMARTPLUGSWITCH",
+    "model": "HS300(US)", "dev_name": "Smart Wi-Fi Power Strip", "icon_hash": "",
+    "feature": "TIM:ENE", "updating": 0, "rssi": -60, "led_off": 0, "latitude_i": 0,
+    "longitude_i": 0, "child_num": 6, "err_code": 0
+}
+
+
+class VirtualDevice:
+    """ state and command handling of one simulated device """
+
+    def __init__(self, host, kind="plug", alias=None, latency=0.0, loss=0.0,
+                 unresponsive=False, discovery_spread=0.1):
+        self.host = host
+        self.kind = kind
+        self.latency = latency
+        # real devices do not answer a broadcast all at the same instant
+        self.discovery_spread = discovery_spread
+        self.loss = loss
+        self.unresponsive = unresponsive
+        mac = "50:C7:BF:%02X:%02X:%02X" % tuple(ipaddress.ip_address(host).packed[1:])
+        if kind == "plug":
+            self.sysinfo = copy.deepcopy(PLUG_SYSINFO)
+        elif kind == "strip":
+            self.sysinfo = copy.deepcopy(STRIP_SYSINFO)
+        else:
+            self.sysinfo = copy.deepcopy(BULB_SYSINFO)
+            if kind == "color_bulb":
+                self.sysinfo.update(model="LB130(EU)", is_color=1,
+                                    description="Smart Wi-Fi LED Bulb with Color Changing")
+        self.sysinfo.update(alias=alias or f"{kind} {host}", mac=mac,
+                            deviceId=mac.replace(":", "") * 3, hwId="0" * 32)
+        if kind == "strip":
+            self.sysinfo["children"] = [
+                {"id": f"{self.sysinfo['deviceId']}{i:02d}", "state": 0, "alias": f"outlet {i + 1}",
+                 "on_time": 0, "next_action": {"type": -1}}
+                for i in range(self.sysinfo["child_num"])]
+        self.requests = 0
+        self.connections = 0
+        self.discoveries = 0
+        self.countdown_rules = []
+        self._countdown = None  # threading.Timer of the enabled rule
+
+    def should_drop(self):
+        return self.unresponsive or random.random() < self.loss
+
+    # command handling
+
+    def _light_state(self, arg=None):
+        state = self.sysinfo["light_state"]
+        if arg:
+            arg = {k: v for k, v in arg.items() if k != "transition_period"}
+            on = arg.pop("on_off", state["on_off"])
+            current = state if state["on_off"] else state["dft_on_state"]
+            current = {k: v for k, v in current.items() if k not in ("on_off", "dft_on_state")}
+            current.update(arg)
+            if on:
+                state = dict(current, on_off=1)
+            else:
+                state = {"on_off": 0, "dft_on_state": current}
+            self.sysinfo["light_state"] = state
+        return dict(state, err_code=0)
+
+    def _children(self, child_ids):
+        """ the addressed outlets of a strip, all of them without a context """
+        children = self.sysinfo.get("children", [])
+        if child_ids is None:
+            return children
+        return [c for c in children if c["id"] in child_ids]
+
+    def _emeter(self, cmd, arg, child_ids=None):
+        now = time.localtime()
+        if cmd == "get_realtime":
+            if self.kind == "strip":
+                # a strip meters one outlet per request
+                children = self._children(child_ids)
+                if child_ids is None or len(children) != 1:
+                    return {"err_code": -1, "err_msg": "module not support"}
+                on = children[0]["state"]
+            else:
+                on = self.sysinfo.get("relay_state") or self.sysinfo.get("light_state", {}).get("on_off")
+            power = 60000 if on else 0
+            return {"power_mw": power, "voltage_mv": 230000, "current_ma": power // 230,
+                    "total_wh": 1234, "err_code": 0}
+        if cmd == "get_daystat":
+            last = now.tm_mday if (arg["year"], arg["month"]) == (now.tm_year, now.tm_mon) else 28
+            return {"day_list": [{"year": arg["year"], "month": arg["month"], "day": d,
+                                  "energy_wh": 100 + d} for d in range(1, last + 1)],
+                    "err_code": 0}
+        if cmd == "get_monthstat":
+            last = now.tm_mon if arg["year"] == now.tm_year else 12
+            return {"month_list": [{"year": arg["year"], "month": m, "energy_wh": 3000 + m}
+                                   for m in range(1, last + 1)], "err_code": 0}
+        return {"err_code": -2, "err_msg": "member not support"}
+
+    def _count_down(self, cmd, arg, child_ids=None):
+        # plugs keep a single count_down rule that sets the relay after delay seconds
+        if cmd == "get_rules":
+            return {"rule_list": [dict(r) for r in self.countdown_rules], "err_code": 0}
+        if cmd == "delete_all_rules":
+            if self._countdown is not None:
+                self._countdown.cancel()
+                self._countdown = None
+            self.countdown_rules = []
+            return {"err_code": 0}
+        if cmd == "add_rule":
+            if self.countdown_rules:
+                return {"err_code": -10, "err_msg": "table is full"}
+            rule = dict(arg, id=f"{len(self.countdown_rules) + 1:032X}")
+            self.countdown_rules.append(rule)
+            if rule.get("enable"):
+                self._countdown = threading.Timer(rule["delay"], self._fire_countdown,
+                                                  (rule, child_ids))
+                self._countdown.daemon = True
+                self._countdown.start()
+            return {"id": rule["id"], "err_code": 0}
+        return {"err_code": -2, "err_msg": "member not support"}
+
+    def _fire_countdown(self, rule, child_ids=None):
+        if self.kind == "strip":
+            for child in self._children(child_ids):
+                child["state"] = rule["act"]
+        else:
+            self.sysinfo["relay_state"] = rule["act"]
+        self.countdown_rules = [r for r in self.countdown_rules if r is not rule]
+        self._countdown = None
+
+    def handle_command(self, target, cmd, arg, child_ids=None):
+        if target == "system":
+            if cmd == "get_sysinfo":
+                for child in self.sysinfo.get("children", []):
+                    # like on real strips this changes on every request
+                    child["on_time"] = child["on_time"] + 1 if child["state"] else 0
+                return copy.deepcopy(self.sysinfo)
+            if cmd == "set_relay_state" and self.kind == "plug":
+                self.sysinfo["relay_state"] = arg["state"]
+                return {"err_code": 0}
+            if cmd == "set_relay_state" and self.kind == "strip":
+                children = self._children(child_ids)
+                if not children:
+                    return {"err_code": -14, "err_msg": "entry not exist"}
+                for child in children:
+                    child["state"] = arg["state"]
+                return {"err_code": 0}
+            if cmd == "set_led_off":
+                self.sysinfo["led_off"] = arg["off"]
+                return {"err_code": 0}
+        elif target == LIGHT_SERVICE and self.kind != "plug":
+            if cmd == "transition_light_state":
+                if not self.sysinfo["is_color"] and ({"hue", "saturation"} & set(arg)):
+                    return {"err_code": -3, "err_msg": "invalid argument"}
+                return self._light_state(arg)
+            if cmd == "get_light_state":
+                return self._light_state()
+        elif target in EMETERS and (self.kind != "plug" or "ENE" in self.sysinfo["feature"]):
+            return self._emeter(cmd, arg, child_ids)
+        elif target == "count_down" and self.kind in ("plug", "strip"):
+            return self._count_down(cmd, arg, child_ids)
+        return {"err_code": -1, "err_msg": "module not support"}
+
+    def handle(self, request):
+        self.requests += 1
+        response = {}
+        child_ids = request.get("context", {}).get("child_ids")
+        for target, cmds in request.items():
+            if target == "context":
+                continue
+            response[target] = {cmd: self.handle_command(target, cmd, arg, child_ids)
+                                for cmd, arg in cmds.items()}
+        return response
+
+
+class _DeviceUDP(asyncio.DatagramProtocol):
+    def __init__(self, device):
+        self.device = device
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.reply(addr)
+
+    def reply(self, addr):
+        if self.device.should_drop():
+            return
+        self.device.discoveries += 1
+        payload = encode_datagram({"system": {"get_sysinfo": dict(self.device.sysinfo)}})
+        delay = self.device.latency + random.random() * self.device.discovery_spread
+        asyncio.get_running_loop().call_later(delay, self.transport.sendto, payload, addr)
+
+
+class _DiscoveryUDP(asyncio.DatagramProtocol):
+    """ stands in for the broadcast address, fans the request out to every device """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def datagram_received(self, data, addr):
+        for udp in self.simulator._udp:
+            udp.reply(addr)
+
+
+class KasaSimulator:
+    def __init__(self, devices, port=9999, discovery_host="127.0.0.1"):
+        self.devices = list(devices)
+        self.port = port
+        self.discovery_host = discovery_host
+        self._loop = None
+        self._thread = None
+        self._servers = []
+        self._transports = []
+        self._udp = []
+        self._writers = set()
+        self._ready = threading.Event()
+
+    @classmethod
+    def fleet(cls, plugs=0, bulbs=0, color_bulbs=0, strips=0, latency=0.0, loss=0.0,
+              unresponsive=0, discovery_spread=0.1, base="127.0.1.1", **kwargs):
+        """ build a simulator with consecutive loopback hosts starting at base """
+        kinds = ["plug"] * plugs + ["bulb"] * bulbs + ["color_bulb"] * color_bulbs + ["strip"] * strips
+        start = ipaddress.ip_address(base)
+        devices = [VirtualDevice(str(start + i), kind, latency=latency, loss=loss,
+                                 unresponsive=i < unresponsive,
+                                 discovery_spread=discovery_spread)
+                   for i, kind in enumerate(kinds)]
+        return cls(devices, **kwargs)
+
+    @property
+    def hosts(self):
+        return [d.host for d in self.devices]
+
+    @property
+    def stats(self):
+        return {"devices": len(self.devices),
+                "discoveries": sum(d.discoveries for d in self.devices),
+                "connections": sum(d.connections for d in self.devices),
+                "requests": sum(d.requests for d in self.devices)}
+
+    def reset_stats(self):
+        for d in self.devices:
+            d.connections = d.requests = d.discoveries = 0
+
+    async def _serve_client(self, device, reader, writer):
+        device.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                payload = await reader.readexactly(HEADER.unpack(header)[0])
+                if device.should_drop():
+                    continue
+                if device.latency:
+                    await asyncio.sleep(device.latency)
+                reply = encrypt(json.dumps(device.handle(decode_response(payload))))
+                writer.write(HEADER.pack(len(reply)) + reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+        for device in self.devices:
+            server = await asyncio.start_server(
+                lambda r, w, d=device: self._serve_client(d, r, w), device.host, self.port)
+            self._servers.append(server)
+            transport, udp = await loop.create_datagram_endpoint(
+                lambda d=device: _DeviceUDP(d), local_addr=(device.host, self.port))
+            self._transports.append(transport)
+            self._udp.append(udp)
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DiscoveryUDP(self), local_addr=(self.discovery_host, self.port))
+        self._transports.append(transport)
+
+    async def _stop(self):
+        for server in self._servers:
+            server.close()
+        # drop the connections clients keep open, their handlers end on EOF
+        for writer in list(self._writers):
+            writer.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        for transport in self._transports:
+            transport.close()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._start())
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._stop())
+        self._loop.close()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="KasaSimulator", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._servers, self._transports, self._udp = [], [], []
+        self._ready.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
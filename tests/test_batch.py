@@ -0,0 +1,59 @@
+from ovos_iot_plugin_kasa import kasa
+
+
+def test_plug_many(fleet):
+    sim = fleet(plugs=3)
+    assert kasa.plug_turn_on_many(sim.hosts) == {h: {} for h in sim.hosts}
+    assert kasa.get_plug_state_many(sim.hosts) == {h: "ON" for h in sim.hosts}
+    kasa.plug_led_many(sim.hosts[:1], state=False)
+    assert [d.sysinfo["led_off"] for d in sim.devices] == [1, 0, 0]
+    infos = kasa.get_plug_sys_info_many(sim.hosts)
+    assert [infos[h]["alias"] for h in sim.hosts] == [d.sysinfo["alias"] for d in sim.devices]
+
+
+def test_many_reports_failures_per_host(fleet):
+    sim = fleet(plugs=3, unresponsive=1)
+    results = kasa.plug_turn_off_many(sim.hosts + sim.hosts[1:], timeout=0.3)
+    # duplicates are sent once, the dead device does not fail the others
+    assert list(results) == sim.hosts
+    assert isinstance(results[sim.hosts[0]], Exception)
+    assert results[sim.hosts[1]] == results[sim.hosts[2]] == {}
+
+
+def test_bulb_many_skips_missing_capabilities(fleet):
+    sim = fleet(plugs=1, bulbs=1, color_bulbs=1)
+    plug, white, color = sim.hosts
+    results = kasa.set_bulb_color_many([white, color], color_name="red")
+    assert results[white] is None
+    assert results[color]["hue"] == 0 and results[color]["saturation"] == 100
+    # the white bulb was only asked for its capabilities
+    assert sim.devices[1].sysinfo["light_state"]["color_temp"] == 2700
+    assert sim.devices[1].requests == 1
+
+    results = kasa.set_bulb_brightness_many([white, color], 40)
+    assert [results[h]["brightness"] for h in (white, color)] == [40, 40]
+    # capabilities are known now, no second sysinfo request
+    assert sim.devices[1].requests == 2
+
+    kasa.bulb_turn_off_many([white, color])
+    assert [d.sysinfo["light_state"]["on_off"] for d in sim.devices[1:]] == [0, 0]
+    kasa.bulb_turn_on_many([white, color])
+    assert [d.sysinfo["light_state"]["on_off"] for d in sim.devices[1:]] == [1, 1]
+
+
+def test_group_scene(fleet, make_plugin):
+    sim = fleet(plugs=1, bulbs=1, color_bulbs=1)
+    plugin = make_plugin(sim, refresh_delay=5)
+    # discovery replies arrive in any order
+    devices = {d.host: d for d in plugin.scan()}
+    plug, white, color = [devices[h] for h in sim.hosts]
+    group = plugin.group([plug, white, color])
+    result = group.change_color("blue")
+    assert len(result.results) == 3 and result.ok
+    # a plug has no color, it is reported as skipped rather than dropped
+    assert [r.device_id for r in result.skipped] == [plug.device_id]
+    assert sim.devices[2].sysinfo["light_state"]["hue"] == 240
+    result = group.turn_off()
+    assert len(result.succeeded) == 3
+    assert sim.devices[0].sysinfo["relay_state"] == 0
+    assert [d.sysinfo["light_state"]["on_off"] for d in sim.devices[1:]] == [0, 0]
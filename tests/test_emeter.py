@@ -0,0 +1,72 @@
+from datetime import date
+
+import pytest
+
+from ovos_iot_plugin_kasa import emeter, kasa
+from ovos_iot_plugin_kasa.emeter import EmeterStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = EmeterStore(":memory:", refresh_interval=60)
+    monkeypatch.setattr(emeter, "_STORE", store)
+    yield store
+    store.close()
+
+
+def test_finished_month_is_fetched_once(fleet, store):
+    sim = fleet(plugs=1)
+    store.refresh_interval = 0
+    last_year = date.today().year - 1
+    days = store.get_daily("D1", sim.hosts[0], last_year, 2)
+    assert days == {d: 100 + d for d in range(1, 29)}
+    assert store.get_daily("D1", sim.hosts[0], last_year, 2, kwh=True)[1] == 0.101
+    assert sim.devices[0].requests == 1
+
+
+def test_running_month_is_refreshed_after_refresh_interval(fleet, store):
+    sim = fleet(plugs=1)
+    today = date.today()
+    days = store.get_daily("D1", sim.hosts[0])
+    assert max(days) == today.day
+    store.get_daily("D1", sim.hosts[0])
+    assert sim.devices[0].requests == 1
+    store.refresh_interval = 0
+    store.get_daily("D1", sim.hosts[0])
+    assert sim.devices[0].requests == 2
+
+
+def test_monthly(fleet, store):
+    sim = fleet(plugs=1)
+    today = date.today()
+    last_year = store.get_monthly("D1", sim.hosts[0], today.year - 1)
+    assert last_year == {m: 3000 + m for m in range(1, 13)}
+    requests = sim.devices[0].requests
+    assert store.get_monthly("D1", sim.hosts[0], today.year - 1) == last_year
+    assert sim.devices[0].requests == requests
+
+    months = store.get_monthly("D1", sim.hosts[0])
+    # the running month is the sum of its days
+    assert months[today.month] == sum(100 + d for d in range(1, today.day + 1))
+    assert all(months[m] == 3000 + m for m in range(1, today.month))
+
+
+def test_helpers_and_devices_share_one_history(fleet, make_plugin, store):
+    sim = fleet(plugs=1)
+    plug, = make_plugin(sim).scan()
+    kasa.get_plug_daily_consumption(sim.hosts[0])
+    plug.daily_consumption()
+    assert store.devices() == [sim.devices[0].sysinfo["deviceId"]]
+
+
+def test_helpers_key_history_by_device_id(fleet, store):
+    sim = fleet(plugs=1)
+    assert kasa.get_plug_monthly_consumption(sim.hosts[0])
+    assert store.devices() == [sim.devices[0].sysinfo["deviceId"]]
+
+
+def test_plug_without_emeter(fleet, store):
+    sim = fleet(plugs=1)
+    sim.devices[0].sysinfo["feature"] = "TIM"
+    assert kasa.get_plug_daily_consumption(sim.hosts[0]) is None
+    assert store.devices() == []
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from ovos_iot_plugin_kasa.aio import get_engine
+from ovos_iot_plugin_kasa.operations import COUNTDOWN_RULE, Deadline, DeadlineExceeded, \
+    async_reboot, run_operation
+from tests.conftest import wait_until
+
+
+def test_reboot(fleet):
+    sim = fleet(plugs=1)
+    plug = sim.devices[0]
+    plug.sysinfo["relay_state"] = 1
+    states = []
+    future = run_operation(async_reboot(plug.host, off_time=0.3, interval=0.05))
+    assert wait_until(lambda: states.append(plug.sysinfo["relay_state"]) or 0 in states)
+    sysinfo = future.result(5)
+    assert sysinfo["relay_state"] == 1 and plug.sysinfo["relay_state"] == 1
+
+
+def test_reboot_with_countdown(fleet):
+    sim = fleet(plugs=1)
+    plug = sim.devices[0]
+    sysinfo = run_operation(async_reboot(plug.host, off_time=1, countdown=True,
+                                         interval=0.05)).result(5)
+    # switched back on by the rule, not by a second command
+    assert sysinfo["relay_state"] == 1
+    assert plug.countdown_rules == []
+
+
+def test_cancelled_reboot_switches_back_on(fleet):
+    sim = fleet(plugs=1)
+    plug = sim.devices[0]
+    future = run_operation(async_reboot(plug.host, off_time=5, interval=0.05))
+    assert wait_until(lambda: plug.sysinfo["relay_state"] == 0 and plug.requests >= 2)
+    future.cancel()
+    assert wait_until(lambda: plug.sysinfo["relay_state"] == 1)
+
+
+def test_cancelled_countdown_reboot_removes_its_rule(fleet):
+    sim = fleet(plugs=1)
+    plug = sim.devices[0]
+    future = run_operation(async_reboot(plug.host, off_time=5, countdown=True, interval=0.05))
+    assert wait_until(lambda: plug.countdown_rules)
+    assert plug.countdown_rules[0]["name"] == COUNTDOWN_RULE
+    future.cancel()
+    assert wait_until(lambda: plug.sysinfo["relay_state"] == 1)
+    assert plug.countdown_rules == []
+
+
+def test_reboot_deadline(fleet):
+    sim = fleet(plugs=1, latency=0.2)
+    plug = sim.devices[0]
+    # the off time does not fit once the off command and its check are done
+    future = run_operation(async_reboot(plug.host, off_time=0.5, timeout=0.3,
+                                        countdown=True, interval=0.05))
+    with pytest.raises(DeadlineExceeded):
+        future.result(5)
+    # switched back on right away, the pending rule is removed
+    assert plug.sysinfo["relay_state"] == 1
+    assert plug.countdown_rules == []
+
+
+def test_failed_reboot_switches_back_on(fleet):
+    sim = fleet(plugs=1, latency=0.2)
+    plug = sim.devices[0]
+    plug.sysinfo["relay_state"] = 1
+    future = run_operation(async_reboot(plug.host, off_time=0.5, timeout=0.3, interval=0.05))
+    with pytest.raises(DeadlineExceeded):
+        future.result(5)
+    # restored before the error was raised, no countdown rule involved
+    assert plug.sysinfo["relay_state"] == 1
+    assert plug.countdown_rules == []
+
+
+def test_deadline():
+    deadline = Deadline(0.3)
+    assert 0 < deadline.timeout() <= 0.3
+    with pytest.raises(DeadlineExceeded):
+        get_engine().run(deadline.sleep(1))
+    get_engine().run(deadline.sleep(0.1))
+    assert not deadline.expired
+    time.sleep(0.25)
+    assert deadline.expired
+    with pytest.raises(DeadlineExceeded):
+        deadline.timeout()
+
+
+def test_strip_outlet_reboot(fleet, make_plugin):
+    sim = fleet(strips=1)
+    for child in sim.devices[0].sysinfo["children"]:
+        child["state"] = 1
+    strip, *outlets = make_plugin(sim).scan()
+    future = outlets[2].reboot(off_time=0.3)
+    seen = set()
+    assert wait_until(lambda: seen.add(tuple(c["state"] for c in sim.devices[0].sysinfo["children"]))
+                      or future.done())
+    sysinfo = future.result()
+    # only the third outlet was switched off and on again
+    assert seen - {(1,) * 6} == {(1, 1, 0, 1, 1, 1)}
+    assert [c["state"] for c in sysinfo["children"]] == [1] * 6
+    assert all(o.is_on for o in outlets)
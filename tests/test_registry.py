@@ -0,0 +1,104 @@
+import pytest
+
+from ovos_iot_plugin_kasa.registry import DeviceRegistry, LAST_SEEN_RESOLUTION
+
+SYSINFO = {"alias": "kitchen", "deviceId": "D1", "model": "HS110(EU)", "relay_state": 1,
+           "feature": "TIM:ENE", "type": "IOT.SMARTPLUGSWITCH"}
+
+
+def test_record_keeps_no_state(tmp_path):
+    registry = DeviceRegistry(str(tmp_path / "devices.json"))
+    registry.record("10.0.0.2", SYSINFO, 1000)
+    entry = registry.sysinfo("10.0.0.2")
+    assert entry["alias"] == "kitchen" and entry["last_seen"] == 1000
+    assert "relay_state" not in entry
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "sub" / "devices.json")
+    registry = DeviceRegistry(path)
+    registry.record("10.0.0.2", SYSINFO)
+    registry.save()
+    loaded = DeviceRegistry(path).load()
+    assert loaded.hosts() == ["10.0.0.2"]
+    assert loaded.sysinfo("10.0.0.2")["deviceId"] == "D1"
+
+
+def test_load_drops_expired_entries(tmp_path):
+    path = str(tmp_path / "devices.json")
+    registry = DeviceRegistry(path)
+    registry.record("10.0.0.2", SYSINFO, 1000)
+    registry.record("10.0.0.3", dict(SYSINFO, deviceId="D2"))
+    registry.save()
+    assert DeviceRegistry(path, max_age=3600).load().hosts() == ["10.0.0.3"]
+
+
+def test_moved_device_kept_under_new_host(tmp_path):
+    registry = DeviceRegistry(str(tmp_path / "devices.json"))
+    registry.record("10.0.0.2", SYSINFO)
+    registry.record("10.0.0.9", SYSINFO)
+    assert registry.hosts() == ["10.0.0.9"]
+
+
+def test_last_seen_alone_is_only_saved_past_the_resolution(tmp_path):
+    path = str(tmp_path / "devices.json")
+    registry = DeviceRegistry(path)
+    registry.record("10.0.0.2", SYSINFO, 1000)
+    registry.save()
+    registry.record("10.0.0.2", SYSINFO, 1000 + LAST_SEEN_RESOLUTION / 2)
+    registry.save()
+    assert DeviceRegistry(path, max_age=1e12).load().sysinfo("10.0.0.2")["last_seen"] == 1000
+    registry.record("10.0.0.2", SYSINFO, 1000 + 2 * LAST_SEEN_RESOLUTION)
+    registry.save()
+    assert DeviceRegistry(path, max_age=1e12).load().sysinfo("10.0.0.2")["last_seen"] == \
+        1000 + 2 * LAST_SEEN_RESOLUTION
+
+
+def test_scan_refreshes_last_seen_of_unchanged_devices(fleet, make_plugin, tmp_path):
+    sim = fleet(plugs=1)
+    plugin = make_plugin(sim, registry=True, registry_path=str(tmp_path / "devices.json"))
+    assert len(list(plugin.scan())) == 1
+    first = plugin.registry.sysinfo(sim.hosts[0])["last_seen"]
+    assert list(plugin.scan()) == []
+    assert plugin.registry.sysinfo(sim.hosts[0])["last_seen"] > first
+
+
+def test_warm_start(fleet, make_plugin, tmp_path):
+    from ovos_iot_plugin_kasa.handles import get_handles
+    from tests.conftest import wait_until
+    sim = fleet(plugs=1, color_bulbs=1)
+    path = str(tmp_path / "devices.json")
+    plugin = make_plugin(sim, registry=True, registry_path=path)
+    list(plugin.scan())
+    # a device that is gone since the last run
+    plugin.registry.record("127.0.1.50", dict(SYSINFO, deviceId="GONE"))
+    plugin.registry.save()
+    for host in sim.hosts:
+        get_handles().forget(host)
+    sim.reset_stats()
+
+    plugin = make_plugin(sim, registry=True, registry_path=path)
+    # usable and capabilities known before any scan
+    bulb = plugin.get_device(sim.hosts[1])
+    assert bulb is not None and get_handles().known(sim.hosts[1]).is_color
+    assert wait_until(lambda: plugin._revalidating == 0)
+    assert sim.stats["requests"] == 2
+    devices = [d.host for d in plugin.scan()]
+    # only confirmed devices are announced, each once
+    assert sorted(devices) == sorted(sim.hosts)
+    assert all(plugin._devices[h].as_dict["host"] == h for h in sim.hosts)
+    assert plugin._devices[sim.hosts[1]].sysinfo_timeout == plugin.sysinfo_timeout
+    assert list(plugin.scan()) == []
+
+
+def test_failed_save_is_retried(tmp_path):
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+    # the parent "directory" is a file, makedirs fails
+    registry = DeviceRegistry(str(blocker / "devices.json"))
+    registry.record("10.0.0.2", SYSINFO)
+    with pytest.raises(OSError):
+        registry.save()
+    blocker.unlink()
+    registry.save()
+    assert DeviceRegistry(str(blocker / "devices.json")).load().hosts() == ["10.0.0.2"]
@@ -0,0 +1,66 @@
+import time
+
+from ovos_iot_plugin_kasa.sampler import EmeterSampler, RingBuffer, normalize_realtime
+from tests.conftest import wait_until
+
+
+def test_ring_buffer_keeps_the_newest():
+    buffer = RingBuffer(3)
+    assert buffer.latest() is None
+    for i in range(5):
+        buffer.append((i, i, 0, 0, 0))
+    assert len(buffer) == 3
+    assert [s.ts for s in buffer] == [2, 3, 4]
+    assert list(buffer.column("power")) == [2, 3, 4]
+    assert buffer.latest().ts == 4
+
+
+def test_normalize_realtime():
+    new = {"power_mw": 60000, "voltage_mv": 230000, "current_ma": 260, "total_wh": 1234}
+    old = {"power": 60.0, "voltage": 230.0, "current": 0.26, "total": 1.234}
+    assert normalize_realtime(new) == (60.0, 230.0, 0.26, 1234.0)
+    assert normalize_realtime(old) == normalize_realtime(new)
+
+
+def test_sampler(fleet):
+    sim = fleet(plugs=1, strips=1)
+    plug, strip = sim.hosts
+    sim.devices[0].sysinfo["relay_state"] = 1
+    outlet = sim.devices[1].sysinfo["children"][0]["id"]
+    sampler = EmeterSampler(interval=0.05)
+    sampler.add_device("plug", plug)
+    sampler.add_device("outlet", strip, child_id=outlet)
+    sampler.start()
+    try:
+        assert wait_until(lambda: len(sampler.buffers["outlet"]) >= 3)
+    finally:
+        sampler.stop()
+    assert sampler.buffers["plug"].latest().power == 60.0
+    assert sampler.buffers["outlet"].latest().power == 0.0
+    jitter = sampler.stats["jitter"]
+    assert jitter["plug"]["failures"] == jitter["outlet"]["failures"] == 0
+
+
+def test_failing_or_slow_callbacks_do_not_stop_sampling(fleet):
+    sim = fleet(plugs=1)
+    sampler = EmeterSampler(interval=0.05)
+    sampler.add_device("plug", sim.hosts[0])
+    received = []
+
+    def broken(device_id, sample):
+        raise ValueError("subscriber bug")
+
+    def slow(device_id, sample):
+        received.append(sample)
+        time.sleep(0.5)
+
+    sampler.subscribe(broken)
+    sampler.subscribe(slow)
+    sampler.start()
+    try:
+        assert wait_until(lambda: sampler.ticks >= 8)
+        assert sampler.running
+    finally:
+        sampler.stop()
+    # sampling went on at its own pace while the callbacks lagged behind
+    assert len(received) < sampler.ticks
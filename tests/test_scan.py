@@ -0,0 +1,114 @@
+from ovos_iot_plugin_kasa.devices import KasaBulb, KasaPlug, KasaRGBWBulb, KasaStrip, KasaStripOutlet
+
+
+def test_scan_finds_every_device(fleet, make_plugin):
+    sim = fleet(plugs=2, bulbs=1, color_bulbs=1)
+    plugin = make_plugin(sim)
+    devices = {d.host: d for d in plugin.scan()}
+    assert sorted(devices) == sorted(sim.hosts)
+    kinds = [devices[h].__class__ for h in sim.hosts]
+    assert kinds == [KasaPlug, KasaPlug, KasaBulb, KasaRGBWBulb]
+    assert devices[sim.hosts[0]].name == sim.devices[0].sysinfo["alias"]
+    # discovery replies carry the full sysinfo, no unicast request was needed
+    assert sim.stats["requests"] == 0
+
+
+def test_scan_only_yields_changed_devices(fleet, make_plugin):
+    sim = fleet(plugs=2, bulbs=1)
+    plugin = make_plugin(sim)
+    heartbeats = []
+    plugin.bus.on("ovos.iot.kasa.heartbeat", heartbeats.append)
+    first = {d.host: d for d in plugin.scan()}
+    assert list(plugin.scan()) == []
+    # unchanged devices are listed in one heartbeat instead of being emitted
+    assert sorted(heartbeats[-1].data["device_ids"]) == sorted(d.device_id for d in first.values())
+
+    sim.devices[1].sysinfo["relay_state"] = 1
+    changed = list(plugin.scan())
+    assert [d.host for d in changed] == [sim.hosts[1]]
+    # updated in place, not rebuilt
+    assert changed[0] is first[sim.hosts[1]]
+    assert changed[0].raw_data["relay_state"] == 1
+
+
+def test_get_device_serves_scanned_devices(fleet, make_plugin):
+    sim = fleet(plugs=1, bulbs=1)
+    plugin = make_plugin(sim)
+    scanned = {d.host: d for d in plugin.scan()}
+    for host in sim.hosts:
+        assert plugin.get_device(host) is scanned[host]
+    assert sim.stats["requests"] == 0
+
+
+def test_get_device_probes_unknown_hosts(fleet, make_plugin):
+    sim = fleet(plugs=1, color_bulbs=1)
+    plugin = make_plugin(sim)
+    bulb = plugin.get_device(sim.hosts[1])
+    assert isinstance(bulb, KasaRGBWBulb)
+    assert sim.devices[1].requests == 1
+    # indexed from now on
+    assert plugin.get_device(sim.hosts[1]) is bulb
+    assert sim.devices[1].requests == 1
+
+
+def test_scan_yields_devices_first_built_by_get_device(fleet, make_plugin):
+    sim = fleet(plugs=2)
+    plugin = make_plugin(sim)
+    probed = plugin.get_device(sim.hosts[0])
+    devices = {d.host: d for d in plugin.scan()}
+    assert sorted(devices) == sorted(sim.hosts)
+    assert devices[sim.hosts[0]] is probed
+    assert list(plugin.scan()) == []
+
+
+def test_get_device_unresponsive(fleet, make_plugin):
+    sim = fleet(plugs=1, unresponsive=1)
+    plugin = make_plugin(sim, sysinfo_timeout=0.2)
+    assert plugin.get_device(sim.hosts[0]) is None
+    assert plugin._backoff.failures(sim.hosts[0]) == 1
+
+
+def test_scan_yields_strip_outlets(fleet, make_plugin):
+    sim = fleet(strips=1)
+    plugin = make_plugin(sim)
+    strip, *outlets = plugin.scan()
+    assert isinstance(strip, KasaStrip)
+    assert len(outlets) == 6
+    assert all(isinstance(o, KasaStripOutlet) and o.strip is strip for o in outlets)
+    assert [o.child_id for o in outlets] == [c["id"] for c in sim.devices[0].sysinfo["children"]]
+
+
+def test_discovery(fleet):
+    from ovos_iot_plugin_kasa import aio, kasa
+
+    sim = fleet(plugs=2, bulbs=1)
+
+    async def discover():
+        return [reply async for reply in aio.async_discover(0.3, target=sim.discovery_host)]
+
+    replies = dict(aio.get_engine().run(discover()))
+    assert sorted(replies) == sorted(sim.hosts)
+    assert replies[sim.hosts[2]]["alias"] == sim.devices[2].sysinfo["alias"]
+    # the sync generator is a front of the same implementation
+    assert sorted(ip for ip, _ in kasa.discover_sysinfo(0.3, target=sim.discovery_host)) == \
+        sorted(sim.hosts)
+    # stopping early does not wait for the timeout
+    discovery = kasa.discover_sysinfo(5, target=sim.discovery_host)
+    next(discovery)
+    discovery.close()
+
+
+def test_scan_publishes_a_summary_not_the_snapshot(fleet, make_plugin):
+    from ovos_utils.messagebus import Message
+    sim = fleet(plugs=2)
+    plugin = make_plugin(sim)
+    summaries, snapshots = [], []
+    plugin.bus.on("ovos.iot.kasa.scan", summaries.append)
+    plugin.bus.on("ovos.iot.kasa.metrics", snapshots.append)
+    list(plugin.scan())
+    list(plugin.scan())
+    assert [s.data["devices"] for s in summaries] == [{"KasaPlug": 2}, {}]
+    assert summaries[1].data["unchanged"] == 2
+    assert snapshots == []
+    plugin.bus.emit(Message("ovos.iot.kasa.metrics.get"))
+    assert len(snapshots) == 1 and "hosts" in snapshots[0].data
@@ -0,0 +1,80 @@
+from tests.conftest import wait_until
+
+DIVERGED = "ovos.iot.kasa.state.diverged"
+
+
+def test_optimistic_write_served_then_confirmed(fleet, make_plugin):
+    sim = fleet(plugs=1)
+    plugin = make_plugin(sim, refresh_delay=0.1, cache_ttl=60)
+    diverged = []
+    plugin.bus.on(DIVERGED, diverged.append)
+    plug, = plugin.scan()
+    plug.turn_on()
+    assert sim.devices[0].sysinfo["relay_state"] == 1
+    # the written state is served without asking the device
+    assert plug.is_on
+    assert sim.devices[0].requests == 1
+    # then read back once in the background
+    assert wait_until(lambda: sim.devices[0].requests == 2)
+    assert wait_until(lambda: plug.host not in plugin._refreshing)
+    assert plug.is_on
+    assert diverged == []
+
+
+def test_divergence_is_reported(fleet, make_plugin):
+    sim = fleet(plugs=1)
+    plugin = make_plugin(sim, refresh_delay=0.2, cache_ttl=60)
+    diverged = []
+    plugin.bus.on(DIVERGED, diverged.append)
+    plug, = plugin.scan()
+    plug.turn_on()
+    assert plug.is_on
+    # someone else switches it off before the read back
+    sim.devices[0].sysinfo["relay_state"] = 0
+    assert wait_until(lambda: diverged)
+    assert diverged[0].data["device_id"] == plug.device_id
+    assert diverged[0].data["fields"] == {"relay_state": {"written": 1, "reported": 0}}
+    # the read back replaced the optimistic state
+    assert not plug.is_on
+
+
+def test_outdated_read_back_is_ignored(fleet, make_plugin):
+    sim = fleet(plugs=1)
+    plugin = make_plugin(sim, cache_ttl=60)
+    plug, = plugin.scan()
+    plug.on_command = None
+    stale = dict(sim.devices[0].sysinfo)
+    requested_at = plug._snapshot_time
+    plug.turn_on()
+    # a reply requested before the write must not undo it
+    assert plug.confirm(stale, requested_at) is None
+    assert plug.is_on
+
+
+def test_rapid_bulb_writes_are_coalesced(fleet, make_plugin):
+    sim = fleet(bulbs=1)
+    plugin = make_plugin(sim, min_write_interval=0.3, refresh_delay=5)
+    bulb, = plugin.scan()
+    for value in range(10, 101, 10):
+        bulb.change_brightness(value)
+    # the first write went out right away, the rest is merged into one
+    assert sim.devices[0].requests == 1
+    stats = bulb.write_stats
+    assert stats["submitted"] == 10 and stats["pending"]
+    assert wait_until(lambda: not bulb.write_stats["pending"] and bulb.write_stats["sent"] == 2)
+    assert bulb.write_stats["dropped"] == 8
+    assert sim.devices[0].requests == 2
+    assert sim.devices[0].sysinfo["light_state"]["brightness"] == 100
+
+
+def test_flush_sends_pending_write(fleet, make_plugin):
+    sim = fleet(bulbs=1)
+    plugin = make_plugin(sim, min_write_interval=10, refresh_delay=5)
+    bulb, = plugin.scan()
+    bulb.change_brightness(20)
+    bulb.change_brightness(30)
+    bulb.turn_off()
+    assert sim.devices[0].requests == 1
+    bulb.flush()
+    state = sim.devices[0].sysinfo["light_state"]
+    assert state["on_off"] == 0 and state["dft_on_state"]["brightness"] == 30
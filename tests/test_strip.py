@@ -0,0 +1,51 @@
+def states(virtual):
+    return [c["state"] for c in virtual.sysinfo["children"]]
+
+
+def test_outlet_commands_address_one_outlet(fleet, make_plugin):
+    sim = fleet(strips=1)
+    strip, *outlets = make_plugin(sim, refresh_delay=5).scan()
+    outlets[1].turn_on()
+    assert states(sim.devices[0]) == [0, 1, 0, 0, 0, 0]
+    assert outlets[1].is_on and not outlets[0].is_on
+    outlets[1].turn_off()
+    assert states(sim.devices[0]) == [0] * 6
+
+
+def test_strip_switches_every_outlet(fleet, make_plugin):
+    sim = fleet(strips=1)
+    strip, *outlets = make_plugin(sim, refresh_delay=5).scan()
+    strip.turn_on()
+    assert states(sim.devices[0]) == [1] * 6
+    assert strip.is_on and all(o.is_on for o in outlets)
+
+
+def test_set_outlets_one_request_per_state(fleet, make_plugin):
+    sim = fleet(strips=1)
+    strip, *outlets = make_plugin(sim, refresh_delay=5).scan()
+    requests = sim.devices[0].requests
+    strip.set_outlets({outlets[0]: True, outlets[2]: True, outlets[3].child_id: True,
+                       outlets[5]: False})
+    assert sim.devices[0].requests == requests + 2
+    assert states(sim.devices[0]) == [1, 0, 1, 1, 0, 0]
+
+
+def test_outlets_read_from_one_snapshot(fleet, make_plugin):
+    sim = fleet(strips=1)
+    strip, *outlets = make_plugin(sim, cache_ttl=60).scan()
+    strip.invalidate()
+    sim.devices[0].sysinfo["children"][4]["state"] = 1
+    assert [o.is_on for o in outlets] == [False] * 4 + [True, False]
+    # one sysinfo request refreshed every outlet
+    assert sim.devices[0].requests == 1
+
+
+def test_outlet_consumption(fleet, make_plugin):
+    sim = fleet(strips=1)
+    strip, *outlets = make_plugin(sim).scan()
+    outlets[0].turn_on()
+    readings = strip.outlet_consumption()
+    assert list(readings) == [o.child_id for o in outlets]
+    assert readings[outlets[0].child_id]["power_mw"] > 0
+    assert readings[outlets[1].child_id]["power_mw"] == 0
+    assert outlets[0].current_consumption == readings[outlets[0].child_id]